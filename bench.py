@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+#
+# Cardigan - benchmarks for Deck and the command handlers
+#
+#    Part of the Salt Force Five project.
+#
+# Copyright (c) 2016, Brandon Streiff
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all
+# copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+# WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+# DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+# PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+# Usage: ./bench.py [--sizes 1000,10000,100000] [--work-dir DIR] [--json FILE]
+#
+# Synthetic decks are generated once per size (from a fixed seed) into
+# the work directory and reused by later runs; each run works on a
+# scratch copy, since saves and draws change the deck. Everything runs
+# in-process; the mod_python request is replaced with a stand-in, so
+# no web server is needed.
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import slack
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+ALL_SIZES = (1000, 10000, 100000, 1000000)
+
+# Stand-ins for mod_python's request object and util.FieldStorage.
+class FakeRequest(object):
+    def __init__(self, form):
+        self.form = form
+        self.content_type = None
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+class FakeFieldStorage(object):
+    def __init__(self, req, keep_blank_values=0):
+        self.req = req
+
+    def keys(self):
+        return self.req.form.keys()
+
+    def getfirst(self, key):
+        return self.req.form[key].encode('utf-8')
+
+class FakeUtil(object):
+    FieldStorage = FakeFieldStorage
+
+class FakeApache(object):
+    OK = 0
+
+def install_fake_mod_python():
+    if slack.util is None:
+        slack.util = FakeUtil
+    if slack.apache is None:
+        slack.apache = FakeApache
+
+def call_handler(team_id, text):
+    req = FakeRequest({
+        'text': text,
+        'team_id': team_id,
+        'user_id': u"UBENCH",
+        'user_name': u"bench",
+        'command': u"/cah",
+        'token': u"bench-token",
+    })
+    slack.handler(req)
+    return req
+
+# Deterministic made-up vocabulary, so that every run (and machine)
+# benchmarks the same decks.
+def make_vocabulary(rng, size=5000):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while (len(words) < size):
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+def generate_records(size, seed=1):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    authors = [ (u"U{0:04d}".format(i), u"user{0}".format(i)) for i in range(50) ]
+    for color in (u"black", u"white"):
+        for n in range(size):
+            words = [ rng.choice(vocabulary) for _ in range(rng.randint(3, 8)) ]
+            if (color == u"black"):
+                for _ in range(rng.choice((1, 1, 1, 2, 3))):
+                    words.insert(rng.randint(0, len(words)), slack.blank_pattern)
+            # The counter keeps every card unique.
+            words.append(u"{0}".format(n))
+            (user_id, user_name) = rng.choice(authors)
+            yield { 'color': color, 'text': u" ".join(words),
+                    'user_id': user_id, 'user_name': user_name }
+
+def deck_name(size):
+    return "bench{0}".format(size)
+
+def deck_path(size):
+    return os.path.join(slack.db_path, deck_name(size) + "-cards.db")
+
+def ensure_deck(size):
+    if os.path.exists(deck_path(size)):
+        return
+    started = time.time()
+    deck = slack.Deck(deck_name(size))
+    try:
+        result = deck.import_cards(generate_records(size),
+                                   slack.User(id=u"UBENCH", name=u"bench"),
+                                   batch_size=10000)
+    finally:
+        deck.close()
+    print("generated {0} ({1} cards) in {2:.1f}s".format(
+        deck_name(size), result.inserted, time.time() - started), file=sys.stderr)
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+def measure(name, fn, iterations, warmup=3):
+    for _ in range(min(warmup, iterations)):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+
+    # Python-level allocations for a single call, measured separately so
+    # that tracing doesn't skew the timings.
+    tracemalloc.start()
+    fn()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'name': name,
+        'iterations': iterations,
+        'mean_ms': 1000 * sum(samples) / len(samples),
+        'p50_ms': 1000 * percentile(samples, 0.50),
+        'p90_ms': 1000 * percentile(samples, 0.90),
+        'p99_ms': 1000 * percentile(samples, 0.99),
+        'peak_kb': peak / 1024.0,
+    }
+
+# Wall time of a fresh interpreter importing slack, less that of one
+# that imports nothing: what a new worker process pays before its
+# first request.
+def measure_startup(runs=10):
+    here = os.path.dirname(os.path.abspath(__file__))
+    def best(code):
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.check_call([sys.executable, "-c", code], cwd=here)
+            samples.append(time.perf_counter() - started)
+        return min(samples)
+    return {
+        'interpreter_ms': 1000 * best("pass"),
+        'import_slack_ms': 1000 * (best("import slack") - best("pass")),
+    }
+
+def consume(iterable):
+    for _ in iterable:
+        pass
+
+# Run 'fn' with slack.db_path pointing at a temporary directory holding
+# a copy of the generated deck, which is thrown away afterwards.
+def on_scratch_copy(size, fn):
+    work_dir = slack.db_path
+    ensure_deck(size)
+    scratch_dir = tempfile.mkdtemp(prefix="cardigan-run-")
+    try:
+        shutil.copy(deck_path(size), scratch_dir)
+        slack.db_path = scratch_dir
+        return fn()
+    finally:
+        slack.db_path = work_dir
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def bench_size(size, iterations):
+    return on_scratch_copy(size, lambda: bench_deck(size, iterations))
+
+def bench_deck(size, iterations):
+    name = deck_name(size)
+    deck = slack.Deck(name)
+    rng = random.Random(2)
+    vocabulary = make_vocabulary(random.Random(1))
+    common = vocabulary[len(vocabulary) // 2][0:3]
+    rare = vocabulary[len(vocabulary) // 3]
+    author = slack.User(id=u"UBENCH", name=u"bench")
+    dump_iterations = max(1, min(iterations, 2000000 // (size * 10)))
+
+    # A card text that's already in the deck, for the duplicate check.
+    existing = deck.get_white_card(1).text
+    counter = [0]
+    def save_new():
+        counter[0] += 1
+        deck.save(slack.WhiteCard(text=u"bench {0} {1}".format(counter[0], rng.random()),
+                                  author=author))
+    def save_duplicate():
+        try:
+            deck.save(slack.WhiteCard(text=existing, author=author))
+        except slack.SlackError:
+            pass
+
+    # The same call with one of the optional caches turned on.
+    def enabled(setting, fn):
+        def run():
+            setattr(slack, setting, True)
+            try:
+                return fn()
+            finally:
+                setattr(slack, setting, False)
+        return run
+    lookup_id = size // 2
+
+    # The same call under another draw mode.
+    def in_mode(mode, name, fn):
+        deck.set_config_item(u"draw_mode", mode)
+        try:
+            return measure(name, fn, iterations)
+        finally:
+            deck.set_config_item(u"draw_mode", u"random")
+
+    results = [
+        measure("draw_black", deck.draw_black, iterations),
+        measure("draw_whites(3)", lambda: deck.draw_whites(3), iterations),
+        in_mode(u"bag", "draw_whites(3) bag", lambda: deck.draw_whites(3)),
+        in_mode(u"newer", "draw_whites(3) newer", lambda: deck.draw_whites(3)),
+        in_mode(u"rotate", "draw_whites(3) rotate", lambda: deck.draw_whites(3)),
+        in_mode(u"authors", "draw_whites(3) authors", lambda: deck.draw_whites(3)),
+        measure("get_white_card", lambda: deck.get_white_card(lookup_id), iterations),
+        measure("draw_whites(3) cached", enabled("deck_cache_enabled", lambda: deck.draw_whites(3)), iterations),
+        measure("get_white_card cached", enabled("deck_cache_enabled", lambda: deck.get_white_card(lookup_id)), iterations),
+        measure("search common", lambda: deck.search(common, limit=4), iterations),
+        measure("search_count common", lambda: deck.search_count(common), iterations),
+        measure("search_page common", lambda: deck.search_page(common), iterations),
+        measure("search rare", lambda: deck.search(rare, limit=4), iterations),
+        measure("search short", lambda: deck.search(u"ab", limit=4), iterations),
+        measure("get_status", deck.get_status, iterations),
+        measure("dump", lambda: consume(slack.handle_dump(deck)), dump_iterations, warmup=1),
+        # Opening a deck (connect and schema check) is paid by every
+        # request that misses the deck pool.
+        measure("open deck", lambda: slack.Deck(name).close(), iterations),
+        measure("handler draw", lambda: call_handler(name, u""), iterations),
+        measure("handler draw cold", lambda: (slack.deck_pool.close(), call_handler(name, u"")),
+                iterations),
+        measure("handler search", lambda: call_handler(name, u"search " + common), iterations),
+        measure("handler status", lambda: call_handler(name, u"status"), iterations),
+        measure("handler search cached", enabled("response_cache_enabled",
+                lambda: call_handler(name, u"search " + common)), iterations),
+        measure("handler status cached", enabled("response_cache_enabled",
+                lambda: call_handler(name, u"status")), iterations),
+        # Writes last, so they don't change what the reads above see.
+        measure("save duplicate", save_duplicate, iterations),
+        measure("save new", save_new, iterations),
+    ]
+    deck.close()
+    slack.deck_pool.close()
+    slack.deck_cache.clear()
+    slack.response_cache.clear()
+    return results
+
+def print_results(size, results):
+    print("")
+    print("{0} cards per color".format(size))
+    print("{0:<22} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}".format(
+        "operation", "n", "mean ms", "p50 ms", "p90 ms", "p99 ms", "peak KiB"))
+    for r in results:
+        print("{0:<22} {1:>7} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>10.3f} {6:>10.1f}".format(
+            r['name'], r['iterations'], r['mean_ms'], r['p50_ms'],
+            r['p90_ms'], r['p99_ms'], r['peak_kb']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Cardigan decks and handlers.")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="cards per color, comma separated, or 'all' for {0} "
+                             "(default: %(default)s)".format(",".join(str(s) for s in ALL_SIZES)))
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="timed calls per operation (default: %(default)s)")
+    parser.add_argument("--work-dir",
+                        help="where generated decks are kept between runs "
+                             "(default: a temporary directory, removed afterwards)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    if (args.sizes == "all"):
+        sizes = ALL_SIZES
+    else:
+        sizes = [ int(s) for s in args.sizes.split(",") ]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="cardigan-bench-")
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    slack.db_path = work_dir
+    # One file per generated deck (see deck_path), whatever
+    # CARDIGAN_DB_SHARDS says.
+    slack.db_shards = 0
+    slack.metrics_enabled = False
+    slack.response_cache_enabled = False
+    install_fake_mod_python()
+
+    report = { 'startup': measure_startup(), 'sizes': {} }
+    print("startup: interpreter {0:.1f} ms, import slack {1:.1f} ms".format(
+        report['startup']['interpreter_ms'], report['startup']['import_slack_ms']))
+    try:
+        for size in sizes:
+            results = bench_size(size, args.iterations)
+            report['sizes'][str(size)] = results
+            print_results(size, results)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    # ru_maxrss is in KiB on Linux (bytes on macOS).
+    report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("")
+    print("max RSS: {0} KiB".format(report['max_rss_kb']))
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(report, fp, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
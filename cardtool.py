@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+#
+# Cardigan - command line tools for managing card decks
+#
+#    Part of the Salt Force Five project.
+#
+# Copyright (c) 2016, Brandon Streiff
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all
+# copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+# WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+# DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+# PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import csv
+import io
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import zipfile
+from urllib.request import pathname2url
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Only needed for "analytics --format parquet".
+    pyarrow = None
+
+import slack
+
+CSV_FIELDS = ('color', 'card_id', 'text', 'user_id', 'user_name')
+
+def guess_format(filename, fmt):
+    if fmt:
+        return fmt
+    if filename.lower().endswith(".csv"):
+        return "csv"
+    return "jsonl"
+
+def read_jsonl(fp):
+    for line in fp:
+        line = line.strip()
+        if (line == ""):
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Counted as skipped by Deck.import_cards.
+            yield None
+
+def read_csv(fp):
+    for row in csv.DictReader(fp):
+        yield row
+
+def write_jsonl(records, fp):
+    for record in records:
+        fp.write(json.dumps(record))
+        fp.write("\n")
+
+def write_csv(records, fp):
+    writer = csv.DictWriter(fp, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+
+def open_input(filename):
+    if (filename == "-"):
+        return sys.stdin
+    return io.open(filename, "r", encoding="utf-8", newline="")
+
+def open_output(filename):
+    if (filename == "-"):
+        return sys.stdout
+    return io.open(filename, "w", encoding="utf-8", newline="")
+
+# Per-card columns of the analytics export, with their array typecodes.
+ANALYTICS_COLUMNS = (
+    ('team', 'i'),          # index into the team names
+    ('color', 'b'),         # 0 for black, 1 for white
+    ('card_id', 'q'),
+    ('author', 'i'),        # index into the author ids and names
+    ('pick', 'h'),          # white cards a black card takes, 0 for white cards
+    ('draw_count', 'q'),
+    ('last_drawn', 'q'),    # Unix time, or 0 if never drawn
+)
+
+# Strings stored back to back as UTF-8, with the offset each one starts
+# at and, last, the end of the data: string i is
+# data[offsets[i]:offsets[i + 1]].
+class StringTable(object):
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('q', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, text):
+        self.data += (text or u"").encode("utf-8")
+        self.offsets.append(len(self.data))
+
+# The analytics export of one deck, as parallel arrays (one item per
+# card) and the string tables they index. Authors are numbered within
+# the deck; the 'team' column is left to the writers, which number the
+# decks.
+class CardColumns(object):
+    def __init__(self, team_id):
+        self.team_id = team_id
+        self.columns = OrderedDict((name, array(code)) for (name, code) in ANALYTICS_COLUMNS
+                                   if name != 'team')
+        self.texts = StringTable()
+        self.author_ids = StringTable()
+        self.author_names = StringTable()
+        self.authors = {}
+
+    def __len__(self):
+        return len(self.columns['card_id'])
+
+    def author(self, user_id, user_name):
+        key = (user_id or u"", user_name or u"")
+        number = self.authors.get(key)
+        if (number is None):
+            number = self.authors[key] = len(self.author_ids)
+            self.author_ids.append(key[0])
+            self.author_names.append(key[1])
+        return number
+
+    # Read the deck from the file open on 'connection'.
+    def read(self, connection):
+        c = self.columns
+        for (color, card_class) in enumerate((slack.BlackCard, slack.WhiteCard)):
+            rows = slack.draw_stats(connection, self.team_id, card_class)
+            for (card_id, text, user_id, user_name, draw_count, last_drawn) in rows:
+                if (card_class is slack.BlackCard):
+                    pick = slack.BlackCard(text=text).get_pick_count()
+                else:
+                    pick = 0
+                c['color'].append(color)
+                c['card_id'].append(card_id)
+                c['author'].append(self.author(user_id, user_name))
+                c['pick'].append(pick)
+                c['draw_count'].append(draw_count)
+                c['last_drawn'].append(last_drawn or 0)
+                self.texts.append(text)
+
+# A read-only connection to an existing deck file. Unlike opening a
+# Deck, it never migrates the schema, takes a write lock or creates a
+# missing file.
+def connect_read_only(path):
+    return sqlite3.connect("file:" + pathname2url(os.path.abspath(path)) + "?mode=ro",
+                           uri=True, timeout=slack.db_busy_timeout / 1000.0)
+
+# Runs in the pool's worker processes, which may not share this one's
+# settings. Returns (team_id, CardColumns or None, error message).
+def read_card_columns(job):
+    (db_path, db_shards, team_id) = job
+    slack.db_path = db_path
+    slack.db_shards = db_shards
+    path = slack.storage_backend().path(team_id)
+    if not os.path.exists(path):
+        return (team_id, None, "no deck found")
+    columns = CardColumns(team_id)
+    connection = connect_read_only(path)
+    try:
+        if not slack.has_deck(connection, team_id):
+            return (team_id, None, "no deck found")
+        columns.read(connection)
+    except sqlite3.OperationalError:
+        return (team_id, None, "deck file is in an older format; "
+                               "run cardtool.py migrate on it first")
+    finally:
+        connection.close()
+    return (team_id, columns, None)
+
+# Results of read_card_columns for 'jobs', in order, with at most
+# 'window' decks read ahead of the writer.
+def read_decks(jobs, workers, window):
+    if (workers == 1):
+        for job in jobs:
+            yield read_card_columns(job)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(read_card_columns, job))
+            if (len(pending) >= window):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# The header of a NumPy .npy file (format version 1.0) holding 'count'
+# items of array typecode 'typecode', so that the export can be written
+# without NumPy and read with numpy.load. The items follow as raw bytes.
+def npy_header(typecode, count):
+    itemsize = array(typecode).itemsize
+    if (typecode in "fd"):
+        kind = "f"
+    elif typecode.isupper():
+        kind = "u"
+    else:
+        kind = "i"
+    if (itemsize == 1):
+        order = "|"
+    elif (sys.byteorder == "little"):
+        order = "<"
+    else:
+        order = ">"
+    header = "{{'descr': '{0}{1}{2}', 'fortran_order': False, 'shape': ({3},), }}".format(
+        order, kind, itemsize, count)
+    # Magic, version, header length and header, padded with spaces to a
+    # multiple of 64 bytes and ending in a newline.
+    header += " " * (-(10 + len(header) + 1) % 64) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+# Writes the export as a .npz file of NumPy arrays, a deck at a time.
+# Each array is spooled to a temporary file next to the output as decks
+# come in, and copied into the zip by close(), once its length is
+# known. Only the author tables, which every deck indexes into, stay in
+# memory.
+class NpzExport(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.spools = OrderedDict()
+        for (name, code) in ANALYTICS_COLUMNS:
+            self.spools[name] = [code, None, 0]
+        for name in ('text', 'team_name', 'author_id', 'author_name'):
+            self.spools[name + "_offsets"] = ['q', None, 0]
+            self.spools[name + "_data"] = ['B', None, 0]
+            self.spool(name + "_offsets", array('q', [0]))
+        self.teams = 0
+        self.authors = CardColumns(None)
+
+    # Append 'values', an array or bytes, to the array 'name'.
+    def spool(self, name, values):
+        entry = self.spools[name]
+        if (entry[1] is None):
+            entry[1] = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.filename)))
+        entry[1].write(values)
+        entry[2] += len(values)
+
+    def spool_strings(self, name, table):
+        base = self.spools[name + "_data"][2]
+        self.spool(name + "_offsets", array('q', [ base + offset for offset in table.offsets[1:] ]))
+        self.spool(name + "_data", table.data)
+
+    def add(self, columns):
+        count = len(columns)
+        # The deck's authors, renumbered across all decks.
+        authors = array('i', [ self.authors.author(*key) for (key, _) in
+                               sorted(columns.authors.items(), key=lambda item: item[1]) ])
+        for (name, _) in ANALYTICS_COLUMNS:
+            if (name == 'team'):
+                values = array('i', [self.teams]) * count
+            elif (name == 'author'):
+                values = array('i', [ authors[author] for author in columns.columns['author'] ])
+            else:
+                values = columns.columns[name]
+            self.spool(name, values)
+        self.spool_strings('text', columns.texts)
+        team_names = StringTable()
+        team_names.append(columns.team_id)
+        self.spool_strings('team_name', team_names)
+        self.teams += 1
+
+    def close(self):
+        self.spool_strings('author_id', self.authors.author_ids)
+        self.spool_strings('author_name', self.authors.author_names)
+        with zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as fp:
+            for (name, (typecode, spool, count)) in self.spools.items():
+                with fp.open(name + ".npy", "w", force_zip64=True) as entry:
+                    entry.write(npy_header(typecode, count))
+                    if (spool is not None):
+                        spool.seek(0)
+                        shutil.copyfileobj(spool, entry)
+                        spool.close()
+
+def arrow_strings(table):
+    return pyarrow.LargeStringArray.from_buffers(len(table), pyarrow.py_buffer(table.offsets),
+                                                 pyarrow.py_buffer(table.data))
+
+def arrow_ints(values):
+    return pyarrow.Array.from_buffers(getattr(pyarrow, "int{0}".format(8 * values.itemsize))(),
+                                      len(values), [None, pyarrow.py_buffer(values)])
+
+# Writes the same columns as a Parquet file, one row group per deck.
+# Teams, colors and authors are dictionary encoded, so each name is
+# still stored once per row group.
+class ParquetExport(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.writer = None
+        self.colors = StringTable()
+        for card_class in (slack.BlackCard, slack.WhiteCard):
+            self.colors.append(card_class.COLOR)
+
+    def add(self, columns):
+        teams = StringTable()
+        teams.append(columns.team_id)
+        arrays = OrderedDict()
+        arrays['team'] = pyarrow.DictionaryArray.from_arrays(arrow_ints(array('i', [0]) * len(columns)),
+                                                             arrow_strings(teams))
+        for (name, values) in columns.columns.items():
+            arrays[name] = arrow_ints(values)
+        arrays['color'] = pyarrow.DictionaryArray.from_arrays(arrays['color'], arrow_strings(self.colors))
+        arrays['author_id'] = pyarrow.DictionaryArray.from_arrays(arrays['author'], arrow_strings(columns.author_ids))
+        arrays['author_name'] = pyarrow.DictionaryArray.from_arrays(arrays.pop('author'), arrow_strings(columns.author_names))
+        arrays['text'] = arrow_strings(columns.texts)
+        table = pyarrow.Table.from_arrays(list(arrays.values()), names=list(arrays.keys()))
+        if (self.writer is None):
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if (self.writer is None):
+            # No decks: still write the columns, empty.
+            self.add(CardColumns(u""))
+        self.writer.close()
+
+def selected_teams(args, backend=None):
+    if args.all:
+        return (backend or slack.storage_backend()).deck_names()
+    return args.team_ids
+
+def cmd_import(args):
+    fmt = guess_format(args.file, args.format)
+    author = slack.User(id=args.user_id, name=args.user_name)
+    deck = slack.Deck(args.team_id)
+    fp = open_input(args.file)
+    try:
+        if (fmt == "csv"):
+            records = read_csv(fp)
+        else:
+            records = read_jsonl(fp)
+        result = deck.import_cards(records, author, batch_size=args.batch_size)
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+        deck.close()
+
+    print("inserted: {0}, duplicates: {1}, skipped: {2}".format(
+        result.inserted, result.duplicates, result.skipped))
+    return 0
+
+def cmd_export(args):
+    fmt = guess_format(args.file, args.format)
+    deck = slack.Deck(args.team_id)
+    fp = open_output(args.file)
+    try:
+        if (fmt == "csv"):
+            write_csv(deck.export_cards(), fp)
+        else:
+            write_jsonl(deck.export_cards(), fp)
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+        deck.close()
+    return 0
+
+def cmd_rebuild_stats(args):
+    for team_id in selected_teams(args):
+        deck = slack.Deck(team_id)
+        try:
+            deck.rebuild_stats()
+        finally:
+            deck.close()
+        print("{0}: rebuilt".format(team_id))
+    return 0
+
+def cmd_compact(args):
+    for team_id in selected_teams(args):
+        deck = slack.Deck(team_id)
+        try:
+            purged = deck.compact_revisions(keep=args.keep, batch_size=args.batch_size)
+        finally:
+            deck.close()
+        print("{0}: purged {1} revisions".format(team_id, purged))
+    return 0
+
+# Per-card authors, picks and draw counts of every selected deck in one
+# columnar file, reading the decks in parallel.
+def cmd_analytics(args):
+    fmt = args.format
+    if not fmt:
+        fmt = "parquet" if args.file.lower().endswith(".parquet") else "npz"
+    if (fmt == "parquet" and pyarrow is None):
+        print("--format parquet needs the pyarrow package", file=sys.stderr)
+        return 2
+
+    jobs = [ (slack.db_path, slack.db_shards, team_id) for team_id in selected_teams(args) ]
+    workers = args.jobs or os.cpu_count() or 1
+    if (fmt == "parquet"):
+        export = ParquetExport(args.file)
+    else:
+        export = NpzExport(args.file)
+    status = 0
+    cards = 0
+    decks = 0
+    # Each deck is written out as it arrives, so only a few are ever
+    # held in memory at once.
+    for (team_id, columns, error) in read_decks(jobs, workers, 2 * workers):
+        if (columns is None):
+            print("{0}: {1}".format(team_id, error), file=sys.stderr)
+            status = 1
+            continue
+        export.add(columns)
+        cards += len(columns)
+        decks += 1
+    export.close()
+    print("{0} cards from {1} decks".format(cards, decks))
+    return status
+
+# Bring per-file decks up to date, and with --db-shards, copy them
+# into the shard files. Converting a deck from an older version takes a
+# while for big decks and locks its file meanwhile, so run this before
+# deploying a new version rather than leaving it to the first request.
+# Sharded and per-file decks use the same tables, keyed by team, so
+# each copy is a handful of insert-selects. The old files are left in
+# place; remove them once the shards have been checked.
+def cmd_migrate(args):
+    source_backend = slack.PerFileBackend()
+    target_backend = None
+    if (slack.db_shards > 0):
+        target_backend = slack.ShardedBackend(slack.db_shards)
+    status = 0
+    for team_id in selected_teams(args, source_backend):
+        if not os.path.exists(source_backend.path(team_id)):
+            print("{0}: no deck found".format(team_id), file=sys.stderr)
+            status = 1
+            continue
+        try:
+            source = slack.Deck(team_id, backend=source_backend)
+        except slack.SlackError as e:
+            print("{0}: {1}".format(team_id, e.value), file=sys.stderr)
+            status = 1
+            continue
+        if target_backend is None:
+            if source.upgraded:
+                print("{0}: upgraded".format(team_id))
+            else:
+                print("{0}: already up to date".format(team_id))
+            source.close()
+            continue
+        try:
+            deck = slack.Deck(team_id, backend=target_backend)
+            try:
+                deck.copy_from(source)
+            except ValueError as e:
+                print("{0}: {1}".format(team_id, e), file=sys.stderr)
+                status = 1
+                continue
+            finally:
+                deck.close()
+        finally:
+            source.close()
+        print("{0}: migrated to {1}".format(team_id, os.path.basename(target_backend.path(team_id))))
+    return status
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage Cardigan card decks.")
+    parser.add_argument("--db-path", default=slack.db_path,
+                        help="directory holding the deck files (default: %(default)s)")
+    parser.add_argument("--db-shards", type=int, default=slack.db_shards,
+                        help="number of shard files teams are stored in, or 0 for "
+                             "one file per team (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    p = subparsers.add_parser("import", help="bulk load cards from JSON Lines or CSV")
+    p.add_argument("team_id")
+    p.add_argument("file", help="input file, or - for stdin")
+    p.add_argument("--format", choices=("jsonl", "csv"),
+                   help="input format (default: from the file extension)")
+    p.add_argument("--user-id", default="cardtool",
+                   help="author id for records without one")
+    p.add_argument("--user-name", default="cardtool",
+                   help="author name for records without one")
+    p.add_argument("--batch-size", type=int, default=1000,
+                   help="cards per transaction (default: %(default)s)")
+    p.set_defaults(func=cmd_import)
+
+    p = subparsers.add_parser("export", help="write a deck out as JSON Lines or CSV")
+    p.add_argument("team_id")
+    p.add_argument("file", nargs="?", default="-", help="output file, or - for stdout")
+    p.add_argument("--format", choices=("jsonl", "csv"),
+                   help="output format (default: from the file extension)")
+    p.set_defaults(func=cmd_export)
+
+    p = subparsers.add_parser("rebuild-stats", help="recount the cached /cah status numbers")
+    p.add_argument("team_ids", nargs="*")
+    p.add_argument("--all", action="store_true", help="every deck under --db-path")
+    p.set_defaults(func=cmd_rebuild_stats)
+
+    p = subparsers.add_parser("compact", help="purge old card revisions")
+    p.add_argument("team_ids", nargs="*")
+    p.add_argument("--all", action="store_true", help="every deck under --db-path")
+    p.add_argument("--keep", type=int, default=10,
+                   help="revisions to keep per card (default: %(default)s)")
+    p.add_argument("--batch-size", type=int, default=500,
+                   help="revisions deleted per transaction (default: %(default)s)")
+    p.set_defaults(func=cmd_compact)
+
+    p = subparsers.add_parser("analytics", help="write per-card statistics to a columnar file")
+    p.add_argument("file", help="output file (.npz, or .parquet with pyarrow installed)")
+    p.add_argument("team_ids", nargs="*")
+    p.add_argument("--all", action="store_true", help="every deck under --db-path")
+    p.add_argument("--format", choices=("npz", "parquet"),
+                   help="output format (default: from the file extension)")
+    p.add_argument("--jobs", type=int,
+                   help="decks read at once (default: one per CPU)")
+    p.set_defaults(func=cmd_analytics)
+
+    p = subparsers.add_parser("migrate", help="upgrade per-file decks, or with --db-shards, "
+                                            "move them into the shard files")
+    p.add_argument("team_ids", nargs="*")
+    p.add_argument("--all", action="store_true", help="every per-file deck under --db-path")
+    p.set_defaults(func=cmd_migrate)
+
+    args = parser.parse_args(argv)
+    slack.db_path = args.db_path
+    slack.db_shards = args.db_shards
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,13 +22,128 @@
 # PERFORMANCE OF THIS SOFTWARE.
 #
 
-from mod_python import apache
-from mod_python import util
+try:
+    from mod_python import apache
+    from mod_python import util
+except ImportError:
+    # Not running under Apache, e.g. imported by cardtool.py.
+    apache = None
+    util = None
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+import bisect
+import functools
+import glob
 import json
+import logging
+import os
+import random
 import re
 import sqlite3
-
-db_path = "/var/lib/www/cah"
+import sys
+import threading
+import time
+import zlib
+
+try:
+    from urllib.parse import parse_qsl
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urlparse import parse_qsl
+    from urllib2 import Request, urlopen
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+db_path = os.environ.get("CARDIGAN_DB_PATH", "/var/lib/www/cah")
+
+# 0 keeps each team's deck in its own "<team_id>-cards.db" file. Any
+# other number stores all teams in that many "shard-NNN.db" files
+# instead (see ShardedBackend); don't change it once decks exist,
+# except by migrating them with cardtool.py.
+db_shards = int(os.environ.get("CARDIGAN_DB_SHARDS", "0"))
+
+# Maximum number of open decks kept per process (see DeckPool).
+deck_pool_size = 32
+
+# Optional per-process cache of whole decks (see DeckCache), which
+# serves random draws and lookups by id from memory. Bounded by an
+# estimate of the memory the cached decks take up.
+deck_cache_enabled = False
+deck_cache_bytes = 64 * 1024 * 1024
+
+# SQLite connection profile (see Deck.connect). WAL lets draws carry on
+# while someone else is writing; synchronous=normal is safe with WAL
+# (a power cut can lose the last commits, but not corrupt the deck).
+db_journal_mode = "wal"
+db_synchronous = "normal"
+db_busy_timeout = 5000              # milliseconds
+db_cache_size = 2000                # KiB of page cache per connection
+db_mmap_size = 64 * 1024 * 1024     # bytes
+db_cached_statements = 128
+# Attempts (with exponential backoff) for writes that still find the
+# database locked after waiting db_busy_timeout.
+db_busy_retries = 4
+
+# Most rounds "/cah <n>" will deal at once.
+max_rounds = 10
+
+# Draws are counted in memory and written to the deck's last_drawn and
+# draw_count columns in one transaction every draw_flush_size cards or
+# draw_flush_interval seconds, whichever comes first, and when the deck
+# is closed. The "rotate" draw mode doesn't see another process's draws
+# until they've been written.
+draw_flush_size = 100
+draw_flush_interval = 30            # seconds
+
+# In the "newer" draw mode, how much likelier the newest card is to be
+# drawn than the oldest; the cards in between are spaced evenly.
+newest_card_weight = 4.0
+
+# Authors each Deck keeps shared User objects for before starting over.
+max_interned_authors = 10000
+
+# Delayed responses (see DelayedResponder). Slack gives up on a slash
+# command after three seconds; when this is on, the commands listed
+# here are acknowledged straight away and their result is posted to
+# the request's response_url once it's ready. Only response_urls that
+# start with response_url_prefix are used.
+delayed_responses = False
+delayed_commands = (u"search", u"status", u"rounds")
+delayed_workers = 4
+delayed_queue_size = 100
+response_url_prefix = u"https://hooks.slack.com/"
+
+# Cached responses (see ResponseCache) for the commands listed here,
+# whose answer only depends on the deck. Entries are keyed by the
+# deck's version, so card changes are never served stale; settings
+# changed by another process can be, for up to response_cache_ttl
+# seconds.
+response_cache_enabled = True
+response_cache_commands = (u"help", u"status", u"search")
+response_cache_ttl = 30             # seconds
+response_cache_bytes = 4 * 1024 * 1024
+
+# Request timing (see Metrics). The summary is logged to the
+# "cardigan.metrics" logger at most every metrics_log_interval seconds;
+# if metrics_path is set, the WSGI/ASGI apps also serve the full
+# numbers as JSON at that path.
+metrics_enabled = True
+metrics_log_interval = 60
+metrics_path = None
 
 blank_pattern = u":blank:"
 black_emoji = (u":black_square:", u":black_small_square:", u":black_medium_small_square:",
@@ -36,6 +151,16 @@ black_emoji = (u":black_square:", u":black_small_square:", u":black_medium_small
 white_emoji = (u":white_square:", u":white_small_square:", u":white_medium_small_square:",
                u":white_medium_square:", u":white_large_square:", u":white_circle:", u"white")
 
+# Deck settings that can be changed with "/cah config <name> <value>",
+# with the values each one accepts. The first value is the default.
+config_options = OrderedDict([
+    (u"draw_mode", (u"random", u"bag", u"newer", u"rotate", u"authors")),
+    (u"search_page_size", (u"4", u"8", u"12", u"16", u"20")),
+])
+
+# "search <text> after <card id>" continues a search past that card.
+search_after_pattern = re.compile(u"^(.*\\S)\\s+after\\s+([BW])([0-9]+)$", re.IGNORECASE | re.DOTALL)
+
 class SlackError(Exception):
     def __init__(self, value):
         self.value = value
@@ -90,13 +215,15 @@ def uppercase_first(text):
             return text[0].upper() + text[1:]
 
 def round_as_text(black_card, white_cards):
-    text = black_card.text
-    top_card = 0;
+    segments = black_card.get_segments()
+    top_card = len(segments) - 1
 
-    while (text.count(blank_pattern) > 0):
-        answer = quote(white_cards[top_card].text)
-        top_card += 1
-        text = text.replace(blank_pattern, answer, 1);
+    # Answers go between the segments.
+    parts = [ segments[0] ]
+    for i in xrange(top_card):
+        parts.append(quote(white_cards[i].text))
+        parts.append(segments[i + 1])
+    text = u"".join(parts)
 
     # If cards left over, then the end is implied to be a blank.
     if (top_card < len(white_cards)):
@@ -110,17 +237,34 @@ def round_as_dict(black_card, white_cards):
         'white_cards': [ w.as_dict() for w in white_cards ]
     }
 
+# Three or more underscores, and any space between them and a
+# following punctuation mark.
+blank_run_pattern = re.compile(r'_{3,}(?:\s+(?=[,.!?]))?')
+
 def normalize_blanks(text):
-    text = re.sub(r'_{3,}\s+([,.!?])', ':blank:\g<1>', text)
-    text = re.sub(r'_{3,}', ':blank:', text);
-    return text
+    return blank_run_pattern.sub(u':blank:', text)
+
+# Key used to detect duplicate cards: blanks normalized as above,
+# whitespace collapsed, and case folded.
+def normalize_card_text(text):
+    text = u" ".join(normalize_blanks(text).split())
+    try:
+        return text.casefold()
+    except AttributeError:
+        return text.lower()
+
+# Decks hold many thousands of cards, so the card classes use __slots__
+# rather than a per-instance __dict__.
+class User(object):
+    __slots__ = ('id', 'name')
 
-class User:
     def __init__(self, id, name):
         self.id = id
         self.name = name
 
-class Card:
+class Card(object):
+    __slots__ = ('text', 'author', 'card_id')
+
     def __init__(self, text, author=None, card_id=None):
         self.text = text
         self.author = author
@@ -130,15 +274,31 @@ class Card:
         return self.ID_PREFIX+str(self.card_id)
 
 class BlackCard(Card):
+    COLOR = u"black"
     TABLE = u"black_cards"
+    SLOT_TABLE = u"black_slots"
+    SEARCH_TABLE = u"black_search"
+    BAG_TABLE = u"black_bag"
     ID_PREFIX = u"B"
     EMOJI = u":black_square:"
 
+    __slots__ = ('segments', 'segments_text', 'draw')
+
     def __init__(self, text, author=None, card_id=None):
         Card.__init__(self, text, author, card_id)
+        self.segments = None
+        self.segments_text = None
+
+    # The text split on blanks, so a card with k blanks has k+1
+    # segments. Parsed once and reused until the text changes.
+    def get_segments(self):
+        if (self.segments_text is not self.text):
+            self.segments = self.text.split(blank_pattern)
+            self.segments_text = self.text
+        return self.segments
 
     def get_pick_count(self):
-        appears = self.text.count(blank_pattern)
+        appears = len(self.get_segments()) - 1
         if (appears == 0):
             return 1
         else:
@@ -158,17 +318,269 @@ class BlackCard(Card):
                  'card_id': self.card_id }
 
 class WhiteCard(Card):
+    COLOR = u"white"
     TABLE = u"white_cards"
+    SLOT_TABLE = u"white_slots"
+    SEARCH_TABLE = u"white_search"
+    BAG_TABLE = u"white_bag"
     ID_PREFIX = u"W"
     EMOJI = u":white_square:"
 
+    __slots__ = ()
+
     def as_dict(self):
         return { 'text': self.text,
                  'card_id': self.card_id }
 
+def random_slots(size, count):
+    # 'count' distinct slot numbers from 1..size, in random order.
+    return random.sample(xrange(1, size + 1), count)
+
+# Draw weights for the "newer" mode, given (id, user_id) rows in id
+# order: rising evenly from 1 for the oldest card to newest_card_weight.
+def newer_weights(rows):
+    last = max(1, len(rows) - 1)
+    return [ 1.0 + (newest_card_weight - 1.0) * i / last for i in xrange(len(rows)) ]
+
+# Draw weights for the "authors" mode: each author's cards share the
+# same total weight, however many of them there are.
+def author_weights(rows):
+    counts = {}
+    for (_, user_id) in rows:
+        counts[user_id] = counts.get(user_id, 0) + 1
+    return [ 1.0 / counts[user_id] for (_, user_id) in rows ]
+
+def search_phrase(text):
+    # Quote as a single FTS5 string so that user input can't be read
+    # as query syntax.
+    return u'"' + text.replace(u'"', u'""') + u'"'
+
+card_id_pattern = re.compile("^([BW])([0-9]+)$")
+valid_id_pattern = re.compile("^([A-Za-z0-9])+$")
+# ASCII digits only: str.isdigit() also takes "²" and the like, which
+# int() refuses.
+rounds_pattern = re.compile("^[0-9]+$")
+
+# (card class, number) for a card id like "B12" or "w3", or None if it
+# isn't one.
+def parse_card_id(card_id):
+    if (card_id is None):
+        return None
+    match = card_id_pattern.match(card_id.upper())
+    if not match:
+        return None
+    if (match.group(1) == 'B'):
+        return (BlackCard, int(match.group(2)))
+    return (WhiteCard, int(match.group(2)))
+
+# The error for a card id that is malformed or not in the deck.
+def card_id_error(card_id):
+    if (card_id is None or card_id == u""):
+        return SlackError(u"Card id was empty.")
+    card_id = card_id.upper()
+    if (parse_card_id(card_id) is None):
+        return SlackError(u"Invalid card id '{0}'".format(card_id))
+    return SlackError(u"Card '{0}' not found.".format(card_id))
+
 def is_valid_id(text):
-    pattern = re.compile("^([A-Za-z0-9])+$")
-    return pattern.match(text)
+    return valid_id_pattern.match(text)
+
+# Latency histogram with fixed, roughly logarithmic buckets (upper
+# bounds in seconds; the last bucket is everything slower).
+class Histogram:
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+              0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, counts=None, total=0.0):
+        self.counts = counts or [0] * (len(Histogram.BOUNDS) + 1)
+        self.total = total
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(Histogram.BOUNDS, seconds)] += 1
+        self.total += seconds
+
+    def count(self):
+        return sum(self.counts)
+
+    def minus(self, other):
+        return Histogram([ a - b for (a, b) in zip(self.counts, other.counts) ],
+                         self.total - other.total)
+
+    # Upper bound of the bucket holding the q'th quantile.
+    def percentile(self, q):
+        wanted = q * self.count()
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if (n and seen >= wanted):
+                if (i < len(Histogram.BOUNDS)):
+                    return Histogram.BOUNDS[i]
+                return float("inf")
+        return 0.0
+
+    def as_dict(self):
+        count = self.count()
+        return { 'count': count,
+                 'mean_ms': round(1000 * self.total / count, 3) if count else 0,
+                 'p50_ms': 1000 * self.percentile(0.5),
+                 'p95_ms': 1000 * self.percentile(0.95),
+                 'p99_ms': 1000 * self.percentile(0.99) }
+
+# "in (?,?,?)" lists, folded in statement names.
+in_list_pattern = re.compile(r'\(\?(,\?)+\)')
+
+# Per-process request metrics: time spent in each stage of a request
+# (keyed by stage and command), in each SQL statement (keyed by command
+# and statement), and whole requests (keyed by command and team).
+# The command and team come from the request being processed on the
+# current thread.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.context = threading.local()
+        self.stages = {}
+        self.statements = {}
+        self.requests = {}
+        self.statement_names = {}
+        self.last_flush = time.time()
+        self.flushed = {}
+
+    def begin_request(self, command, team):
+        self.context.command = command
+        self.context.team = team
+
+    def end_request(self):
+        self.context.command = None
+        self.context.team = None
+
+    def __command(self):
+        return getattr(self.context, 'command', None) or u"-"
+
+    def __add(self, table, key, seconds):
+        with self.lock:
+            histogram = table.get(key)
+            if (histogram is None):
+                histogram = table[key] = Histogram()
+            histogram.add(seconds)
+
+    def record_stage(self, stage, seconds):
+        if metrics_enabled:
+            self.__add(self.stages, (stage, self.__command()), seconds)
+
+    def record_request(self, seconds):
+        if metrics_enabled:
+            team = getattr(self.context, 'team', None) or u"-"
+            self.__add(self.requests, (self.__command(), team), seconds)
+
+    # Statements are grouped with whitespace collapsed and "in (?,?,...)"
+    # lists folded, so that varying list lengths share one entry.
+    def __statement_name(self, sql):
+        name = self.statement_names.get(sql)
+        if (name is None):
+            name = in_list_pattern.sub(u"(?,...)", u" ".join(sql.split()))[0:120]
+            if (len(self.statement_names) < 1000):
+                self.statement_names[sql] = name
+        return name
+
+    def record_sql(self, sql, seconds):
+        if metrics_enabled:
+            self.__add(self.statements, (self.__command(), self.__statement_name(sql)), seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        started = timer()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, timer() - started)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stages': [ dict(stage=k[0], command=k[1], **v.as_dict())
+                            for (k, v) in sorted(self.stages.items()) ],
+                'requests': [ dict(command=k[0], team=k[1], **v.as_dict())
+                              for (k, v) in sorted(self.requests.items()) ],
+                'statements': [ dict(command=k[0], statement=k[1], **v.as_dict())
+                                for (k, v) in sorted(self.statements.items()) ],
+            }
+
+    # Logs one line summarising each stage since the last flush, if
+    # metrics_log_interval has passed.
+    def maybe_flush(self):
+        now = time.time()
+        if (not metrics_enabled or now - self.last_flush < metrics_log_interval):
+            return
+        with self.lock:
+            if (now - self.last_flush < metrics_log_interval):
+                return
+            self.last_flush = now
+            parts = []
+            for (key, histogram) in sorted(self.stages.items()):
+                previous = self.flushed.get(key)
+                delta = histogram.minus(previous) if previous else histogram
+                self.flushed[key] = Histogram(list(histogram.counts), histogram.total)
+                if (delta.count() == 0):
+                    continue
+                parts.append(u"{0}/{1} n={2} p50={3:g}ms p95={4:g}ms".format(
+                    key[1], key[0], delta.count(),
+                    1000 * delta.percentile(0.5), 1000 * delta.percentile(0.95)))
+        if parts:
+            logging.getLogger("cardigan.metrics").info(u"; ".join(parts))
+
+metrics = Metrics()
+
+# sqlite3 connection and cursor that time every statement they run.
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = timer()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            metrics.record_sql(sql, timer() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = timer()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        finally:
+            metrics.record_sql(sql, timer() - started)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def is_busy_error(e):
+    message = str(e).lower()
+    return "locked" in message or "busy" in message
+
+# Decorator for Deck methods that write: if SQLite reports the database
+# as busy or locked, roll back and try the whole method again after a
+# short randomized backoff.
+def retry_on_busy(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        delay = 0.01
+        attempt = 1
+        while True:
+            try:
+                return method(self, *args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e):
+                    raise
+                self.connection.rollback()
+                if (attempt >= db_busy_retries):
+                    raise
+                time.sleep(delay * (1 + random.random()))
+                delay *= 2
+                attempt += 1
+    return wrapper
 
 class DeckStatus:
     def __init__(self, black_card_count, white_card_count, authors):
@@ -176,121 +588,1101 @@ class DeckStatus:
         self.white_card_count = white_card_count
         self.authors = authors;
 
-class Deck:
-    BLACK_SELECT = u"select text, user_id, user_name, id from black_cards"
-    WHITE_SELECT = u"select text, user_id, user_name, id from white_cards"
-    BLACK_INSERT = u"insert or replace into black_cards (id, text, user_id, user_name) values (?,?,?,?)"
-    WHITE_INSERT = u"insert or replace into white_cards (id, text, user_id, user_name) values (?,?,?,?)"
+class ImportResult:
+    def __init__(self):
+        self.inserted = 0
+        self.skipped = 0
+        self.duplicates = 0
 
-    def __init__(self, deck_name):
+# Storage backends decide which database file holds a team's deck.
+# Every file has the same tables, shared by the teams stored in it and
+# keyed by team_id, so a file's schema doesn't grow with the number of
+# teams and opening a deck in it costs the same however many there are.
+#
+# The default gives every team a file of its own, "<team_id>-cards.db"
+# under db_path.
+class PerFileBackend(object):
+    SUFFIX = "-cards.db"
+
+    def path(self, deck_name):
+        return db_path + "/" + deck_name + PerFileBackend.SUFFIX
+
+    # Names of every deck in this backend.
+    def deck_names(self):
+        names = []
+        for path in glob.glob(os.path.join(db_path, "*" + PerFileBackend.SUFFIX)):
+            names.append(os.path.basename(path)[:-len(PerFileBackend.SUFFIX)])
+        return sorted(names)
+
+# Many teams in a fixed number of "shard-NNN.db" files, picked by a
+# stable hash of the team id.
+class ShardedBackend(object):
+    def __init__(self, shards):
+        self.shards = shards
+
+    # crc32 rather than hash(), which isn't stable between processes.
+    def shard(self, deck_name):
+        return (zlib.crc32(deck_name.encode('utf-8')) & 0xffffffff) % self.shards
+
+    def path(self, deck_name):
+        return db_path + "/shard-{0:03d}.db".format(self.shard(deck_name))
+
+    def deck_names(self):
+        names = []
+        for path in sorted(glob.glob(os.path.join(db_path, "shard-*.db"))):
+            connection = sqlite3.connect(path)
+            try:
+                names += [ row[0] for row in connection.execute(u"select team_id from teams") ]
+            except sqlite3.OperationalError:
+                # No decks in this shard yet.
+                pass
+            finally:
+                connection.close()
+        return sorted(names)
+
+def storage_backend():
+    if (db_shards > 0):
+        return ShardedBackend(db_shards)
+    return PerFileBackend()
+
+# A team's cards take this many rowids in the search indexes, which
+# number them by team (see Deck.__create_search_index).
+search_team_span = 1 << 32
+
+# Tables of a deck file from before teams shared tables, kept (renamed
+# "legacy_...") until their rows have been moved into the new ones.
+legacy_tables = (u"config", BlackCard.TABLE, WhiteCard.TABLE)
+
+class Deck:
+    def __init__(self, deck_name, backend=None):
         if not is_valid_id(deck_name):
             raise ValueError("bad deck name")
 
-        self.connection = sqlite3.connect(db_path + "/" + deck_name + "-cards.db")
+        self.name = deck_name
+        self.backend = backend or storage_backend()
+        self.path = self.backend.path(deck_name)
+        # Guards the connection when the deck is shared between threads
+        # through a DeckPool.
+        self.lock = threading.RLock()
+        self.connection = None
+        # One User per distinct author, shared by all of their cards.
+        self.authors = {}
+        # Draws not yet written out: card id -> (last drawn, count).
+        self.drawn = { BlackCard: {}, WhiteCard: {} }
+        self.drawn_since = None
+        self.connect()
+
+    def connect(self):
+        self.close()
+        # The connection may be handed between request threads by the
+        # pool; self.lock ensures only one of them uses it at a time.
+        started = timer()
+        self.connection = sqlite3.connect(self.path,
+                                          timeout=db_busy_timeout / 1000.0,
+                                          check_same_thread=False,
+                                          cached_statements=db_cached_statements,
+                                          factory=TimedConnection if metrics_enabled else sqlite3.Connection)
+        self.file_id = self.__stat_file()
+        # Weight tables for the weighted draw modes (see __weights); a
+        # replaced file's version numbers mean nothing to them.
+        self.weight_tables = {}
+        self.__configure()
+        connected = timer()
+        metrics.record_stage(u"connect", connected - started)
+
+        self.upgraded = False
+        if (self.__schema_version() < len(self.__schema_steps())):
+            self.__migrate()
+        self.search_base = self.__register() * search_team_span
+        self.search_index = self.__has_search_index()
+        metrics.record_stage(u"schema", timer() - connected)
+
+    # Schema changes, in order. The schema belongs to the database file
+    # rather than to any one team, and its version is SQLite's
+    # user_version: a file at version n has had the first n steps
+    # applied. connect() runs the ones it's missing in one write
+    # transaction, so opening a deck that's up to date costs a single
+    # query. New steps go on the end.
+    def __schema_steps(self):
+        return (self.__create_schema,
+                self.__create_draw_stats)
+
+    def __schema_version(self):
+        cursor = self.connection.cursor()
+        cursor.execute(u"pragma user_version")
+        return cursor.fetchone()[0]
+
+    def __migrate(self):
+        steps = self.__schema_steps()
+        cursor = self.connection.cursor()
+        self.connection.commit()
+        try:
+            cursor.execute(u"begin immediate")
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e):
+                raise
+            # Still locked after the busy timeout: another process is
+            # most likely converting a big deck (see __import_legacy).
+            raise SlackError(u"This deck is being upgraded; try again in a minute.")
+        try:
+            # Read again under the lock: another process may have got
+            # there first.
+            for version in xrange(self.__schema_version(), len(steps)):
+                steps[version]()
+                cursor.execute(u"pragma user_version={0:d}".format(version + 1))
+                self.upgraded = True
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+
+    # This team's number in the file's "teams" table, adding the team
+    # (and its version counter) on first open. Team ids are
+    # case-sensitive; the number is what keeps teams' cards apart in the
+    # shared search indexes.
+    def __register(self):
+        cursor = self.connection.cursor()
+        cursor.execute(u"select number from teams where team_id=?", (self.name,))
+        row = cursor.fetchone()
+        if (row is None):
+            self.__add_team()
+            self.connection.commit()
+            cursor.execute(u"select number from teams where team_id=?", (self.name,))
+            row = cursor.fetchone()
+        return row[0]
+
+    def __add_team(self):
+        cursor = self.connection.cursor()
+        cursor.execute(u"insert or ignore into teams (team_id) values (?)", (self.name,))
+        cursor.execute(u"insert or ignore into config (team_id, name, value) values (?, 'version', 0)", (self.name,))
+
+    # Version 1: the tables, indexes and triggers. A file from before
+    # teams shared tables holds a single deck; its cards and settings
+    # are moved into the new tables, under this deck's name.
+    # The triggers come last, so that the move is a handful of
+    # set-based queries rather than a trip through them for every card.
+    def __create_schema(self):
+        legacy = self.__legacy_tables()
+        if legacy:
+            self.__set_aside_legacy(legacy)
 
         self.connection.execute(
-            u"create table if not exists config ("
-            u"	name        varchar unique primary key,"
-            u"	value       varchar  "
+            u"create table if not exists teams ("
+            u"	number      integer primary key, "
+            u"	team_id     varchar unique  "
             u")")
-
         self.connection.execute(
-            u"create table if not exists black_cards ("
-            u"	id          integer primary key,"
+            u"create table if not exists config ("
+            u"	team_id     varchar, "
+            u"	name        varchar, "
+            u"	value       varchar, "
+            u"	primary key (team_id, name)"
+            u") without rowid")
+
+        for card_class in (BlackCard, WhiteCard):
+            self.__create_cards(card_class)
+            self.__create_slots(card_class)
+            self.__create_bag(card_class)
+        self.__create_history()
+        self.__create_stats()
+        search_index = all([ self.__create_search_index(card_class)
+                             for card_class in (BlackCard, WhiteCard) ])
+
+        if legacy:
+            self.__add_team()
+            self.__import_legacy(legacy, search_index)
+
+        for card_class in (BlackCard, WhiteCard):
+            self.__create_duplicate_check(card_class)
+            self.__create_slot_triggers(card_class)
+            if search_index:
+                self.__create_search_triggers(card_class)
+        self.__create_stats_triggers()
+        self.__create_version()
+        self.__create_revision_triggers()
+        self.__create_removal()
+
+    def __create_cards(self, card_class):
+        table = card_class.TABLE
+        self.connection.execute(
+            u"create table if not exists "+table+u" ("
+            u"	team_id     varchar, "
+            u"	id          integer, "
             u"	text        varchar, "
+            u"	norm_text   varchar, "
             u"	user_id     varchar, "
-            u"	user_name   varchar  "
-            u")")
+            u"	user_name   varchar, "
+            u"	primary key (team_id, id)"
+            u") without rowid")
+
+    # Version 2: when each card was last drawn and how many times, for
+    # the "rotate" draw mode and usage statistics. flush_draws writes
+    # these without bumping the deck's version, so cached copies stay
+    # valid.
+    def __create_draw_stats(self):
+        for card_class in (BlackCard, WhiteCard):
+            table = card_class.TABLE
+            self.connection.execute(u"alter table "+table+u" add column last_drawn integer")
+            self.connection.execute(u"alter table "+table+u" add column draw_count integer default 0")
+            # Never-drawn cards (NULL) sort first.
+            self.connection.execute(
+                u"create index if not exists "+table+u"_last_drawn "
+                u"on "+table+u" (team_id, last_drawn)")
+
+    # False if this SQLite build couldn't create the full-text indexes.
+    def __has_search_index(self):
+        cursor = self.connection.cursor()
+        cursor.execute(u"select count(*) from sqlite_master where name in (?,?)",
+                       (BlackCard.SEARCH_TABLE, WhiteCard.SEARCH_TABLE))
+        return cursor.fetchone()[0] == 2
+
+    # Table names of a deck file from before teams shared tables (its
+    # card tables have no team_id), or None for any other file.
+    def __legacy_tables(self):
+        cursor = self.connection.cursor()
+        cursor.execute(u"select name from sqlite_master where type='table'")
+        tables = set(row[0] for row in cursor.fetchall())
+        if not BlackCard.TABLE in tables:
+            return None
+        cursor.execute(u"pragma table_info("+BlackCard.TABLE+u")")
+        if u"team_id" in [ row[1] for row in cursor.fetchall() ]:
+            return None
+        return tables
+
+    # Move the old tables out of the way of the new ones. Everything
+    # that's rebuilt from the cards (slots, bag, stats, search indexes,
+    # and all triggers and indexes) is dropped instead.
+    def __set_aside_legacy(self, tables):
+        cursor = self.connection.cursor()
+        cursor.execute(u"select type, name from sqlite_master "
+                       u"where type in ('trigger', 'index') and sql is not null")
+        for (kind, name) in cursor.fetchall():
+            cursor.execute(u"drop "+kind+u" if exists "+name)
+        for name in (BlackCard.SEARCH_TABLE, WhiteCard.SEARCH_TABLE,
+                     BlackCard.SLOT_TABLE, WhiteCard.SLOT_TABLE,
+                     BlackCard.BAG_TABLE, WhiteCard.BAG_TABLE,
+                     u"bag_state", u"card_stats"):
+            if name in tables:
+                cursor.execute(u"drop table "+name)
+        for name in legacy_tables:
+            if name in tables:
+                cursor.execute(u"alter table "+name+u" rename to legacy_"+name)
+
+    # Copy the set-aside tables into this deck, then drop them. Each
+    # table is copied with one query, and the slots, stats and search
+    # indexes are built from the result the same way, since their
+    # triggers don't exist yet. The bag is reshuffled on its next draw.
+    # Converting a big deck still takes a while, so the bot's first
+    # request for it may have to wait; "cardtool.py migrate" converts
+    # decks ahead of time.
+    def __import_legacy(self, tables, search_index):
+        cursor = self.connection.cursor()
+        team = (self.name,)
+
+        cursor.execute(u"insert or replace into config (team_id, name, value) "
+                       u"select ?, name, value from legacy_config", team)
+
+        self.connection.create_function("normalize_card_text", 1, normalize_card_text)
+        # Numbers the slots 1..N: rowids of an empty table count up from 1.
+        cursor.execute(u"create temp table if not exists numbered (number integer primary key, card_id integer)")
+        for card_class in (BlackCard, WhiteCard):
+            table = card_class.TABLE
+            cursor.execute(u"insert into "+table+u" "
+                           u"(team_id, id, text, norm_text, user_id, user_name) "
+                           u"select ?, id, text, normalize_card_text(ifnull(text, '')), user_id, user_name "
+                           u"from legacy_"+table, team)
+            # Decks may hold duplicates from before the duplicate check;
+            # the oldest card keeps the key and later copies go without.
+            cursor.execute(u"update "+table+u" set norm_text=null "
+                           u"where team_id=? and id not in ("
+                           u"	select min(id) from "+table+u" where team_id=? group by norm_text)", team * 2)
+
+            cursor.execute(u"delete from numbered")
+            cursor.execute(u"insert into numbered (card_id) "
+                           u"select id from "+table+u" where team_id=? order by id", team)
+            cursor.execute(u"insert into "+card_class.SLOT_TABLE+u" (team_id, slot, card_id) "
+                           u"select ?, number, card_id from numbered", team)
+
+            if search_index:
+                cursor.execute(u"insert into "+card_class.SEARCH_TABLE+u" (rowid, text) "
+                               u"select "+self.__search_rowid(u"c")+u", c.text from "+table+u" c "
+                               u"where c.team_id=?", team)
+        cursor.execute(u"drop table temp.numbered")
+        self.__count_stats()
+
+        for name in legacy_tables:
+            if name in tables:
+                cursor.execute(u"drop table legacy_"+name)
+
+    def __configure(self):
+        cursor = self.connection.cursor()
+        # journal_mode is stored in the file, the rest are per connection.
+        cursor.execute(u"pragma journal_mode=" + db_journal_mode)
+        cursor.execute(u"pragma synchronous=" + db_synchronous)
+        cursor.execute(u"pragma busy_timeout={0:d}".format(db_busy_timeout))
+        cursor.execute(u"pragma cache_size={0:d}".format(-db_cache_size))
+        cursor.execute(u"pragma mmap_size={0:d}".format(db_mmap_size))
+        cursor.fetchall()
+
+    def close(self):
+        if (self.connection is not None):
+            try:
+                self.flush_draws()
+            finally:
+                self.connection.close()
+                self.connection = None
+
+    def __stat_file(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    # True if the database file was removed or replaced (e.g. restored
+    # from a backup) since we opened it.
+    def is_stale(self):
+        return self.connection is None or self.__stat_file() != self.file_id
+
+    # Duplicate detection uses a normalized copy of the text with a
+    # unique index on it, so the check is an index lookup and the
+    # database refuses duplicates even when two saves race. NULLs don't
+    # collide, so removed cards give up their key.
+    def __create_duplicate_check(self, card_class):
+        table = card_class.TABLE
+        self.connection.execute(
+            u"create unique index if not exists "+table+u"_norm_text "
+            u"on "+table+u" (team_id, norm_text)")
+
+    # Each card table has a companion "slot" table which maps a dense
+    # range of numbers (1..N) per team onto card ids. Triggers keep it
+    # dense: new cards are appended, and when a card is deleted the last
+    # slot is moved into the hole. Drawing k random cards is then k
+    # random numbers in 1..N and a primary key lookup for each, instead
+    # of sorting the whole table by RANDOM().
+    def __create_slots(self, card_class):
+        slots = card_class.SLOT_TABLE
+        self.connection.execute(
+            u"create table if not exists "+slots+u" ("
+            u"	team_id     varchar, "
+            u"	slot        integer, "
+            u"	card_id     integer, "
+            u"	primary key (team_id, slot), "
+            u"	unique (team_id, card_id)"
+            u") without rowid")
+
+    def __create_slot_triggers(self, card_class):
+        table = card_class.TABLE
+        slots = card_class.SLOT_TABLE
         self.connection.execute(
-            u"create table if not exists white_cards ("
-            u"	id          integer primary key, "
+            u"create trigger if not exists "+slots+u"_insert after insert on "+table+u" "
+            u"when not exists (select 1 from "+slots+u" where team_id=new.team_id and card_id=new.id) "
+            u"begin "
+            u"	insert into "+slots+u" (team_id, slot, card_id) "
+            u"		select new.team_id, ifnull(max(slot), 0) + 1, new.id from "+slots+u" "
+            u"		where team_id=new.team_id; "
+            u"end")
+        self.connection.execute(
+            u"create trigger if not exists "+slots+u"_delete after delete on "+table+u" "
+            u"begin "+self.__remove_slot_sql(card_class, u"old.team_id", u"old.id")+u"end")
+
+    # Trigger statements that take the card 'card_id' of team 'team_id'
+    # out of the slot table, moving the team's last slot into its place.
+    def __remove_slot_sql(self, card_class, team_id, card_id):
+        slots = card_class.SLOT_TABLE
+        return (u"	insert or replace into "+slots+u" (team_id, slot, card_id) "
+                u"		select team_id, slot, (select card_id from "+slots+u" "
+                u"			where team_id="+team_id+u" order by slot desc limit 1) "
+                u"		from "+slots+u" where team_id="+team_id+u" and card_id="+card_id+u"; "
+                u"	delete from "+slots+u" where team_id="+team_id+u" and card_id="+card_id+u"; ")
+
+    def __rebuild_slots(self, card_class):
+        cursor = self.connection.cursor()
+        cursor.execute(u"delete from "+card_class.SLOT_TABLE+u" where team_id=?", (self.name,))
+        cursor.execute(u"select id from "+card_class.TABLE+u" c "
+                       u"where c.team_id=? and "+self.live(card_class, u"c")+u" order by id", (self.name,))
+        cursor.executemany(u"insert into "+card_class.SLOT_TABLE+u" (team_id, slot, card_id) values (?,?,?)",
+                           [ (self.name, slot + 1, row[0]) for (slot, row) in enumerate(cursor.fetchall()) ])
+        self.connection.commit()
+
+    # The "bag" draw mode deals from a stored shuffle of the deck, so
+    # nothing repeats until every card has come up once. bag_state
+    # holds, per team and color, the next position to deal from, the
+    # last filled position and the highest card id that has been
+    # shuffled in. The bag itself is only filled on the first bag-mode
+    # draw.
+    def __create_bag(self, card_class):
+        self.connection.execute(
+            u"create table if not exists "+card_class.BAG_TABLE+u" ("
+            u"	team_id     varchar, "
+            u"	position    integer, "
+            u"	card_id     integer, "
+            u"	primary key (team_id, position)"
+            u") without rowid")
+        self.connection.execute(
+            u"create table if not exists bag_state ("
+            u"	team_id     varchar, "
+            u"	color       varchar, "
+            u"	cursor      integer, "
+            u"	size        integer, "
+            u"	max_id      integer, "
+            u"	primary key (team_id, color)"
+            u") without rowid")
+
+    # Per-team, per-color, per-author card counts for get_status, kept
+    # up to date by triggers so that status doesn't have to count the
+    # card tables. Authors are keyed by user_id, as the old "group by
+    # user_id" was.
+    def __create_stats(self):
+        self.connection.execute(
+            u"create table if not exists card_stats ("
+            u"	team_id     varchar, "
+            u"	color       varchar, "
+            u"	user_id     varchar, "
+            u"	user_name   varchar, "
+            u"	count       integer, "
+            u"	primary key (team_id, color, user_id)"
+            u") without rowid")
+
+    def __create_stats_triggers(self):
+        for card_class in (BlackCard, WhiteCard):
+            table = card_class.TABLE
+            color = card_class.COLOR
+            add = (u"	insert or ignore into card_stats (team_id, color, user_id, user_name, count) "
+                   u"		values (new.team_id, '"+color+u"', ifnull(new.user_id, ''), new.user_name, 0); "
+                   u"	update card_stats set count=count+1, user_name=new.user_name "
+                   u"		where team_id=new.team_id and color='"+color+u"' and user_id=ifnull(new.user_id, ''); ")
+            remove = (u"	update card_stats set count=count-1 "
+                      u"		where team_id=old.team_id and color='"+color+u"' and user_id=ifnull(old.user_id, ''); "
+                      u"	delete from card_stats "
+                      u"		where team_id=old.team_id and color='"+color+u"' and user_id=ifnull(old.user_id, '') and count<=0; ")
+            self.connection.execute(
+                u"create trigger if not exists "+table+u"_stats_insert after insert on "+table+u" "
+                u"begin "+add+u"end")
+            self.connection.execute(
+                u"create trigger if not exists "+table+u"_stats_delete after delete on "+table+u" "
+                u"begin "+remove+u"end")
+            self.connection.execute(
+                u"create trigger if not exists "+table+u"_stats_update after update of user_id, user_name on "+table+u" "
+                u"when old.user_id is not new.user_id or old.user_name is not new.user_name "
+                u"begin "+remove+add+u"end")
+
+    # "version" in a team's config counts changes to its cards, from
+    # this process or any other, so that a cached copy of the deck can
+    # tell whether it's still current with a single lookup. The row is
+    # added when the team is, or here for teams that predate it.
+    def __create_version(self):
+        self.connection.execute(u"insert or ignore into config (team_id, name, value) "
+                                u"select team_id, 'version', 0 from teams")
+        for card_class in (BlackCard, WhiteCard):
+            table = card_class.TABLE
+            for (event, row) in ((u"insert", u"new"), (u"delete", u"old"),
+                                 (u"update of text, user_id, user_name", u"new")):
+                self.connection.execute(
+                    u"create trigger if not exists "+table+u"_version_"+event.split()[0]+u" "
+                    u"after "+event+u" on "+table+u" "
+                    u"begin update config set value=value+1 "
+                    u"where team_id="+row+u".team_id and name='version'; end")
+
+    # Cards are never deleted or overwritten outright. Each edit appends
+    # the text it replaced to card_revisions, and removing a card
+    # appends it to card_tombstones: the card's row stays (so its id is
+    # never reused), but a trigger takes it out of the slot table, the
+    # stats, the search index and the duplicate check, so draws, search
+    # and status skip it without further filtering.
+    def __create_history(self):
+        self.connection.execute(
+            u"create table if not exists card_revisions ("
+            u"	revision    integer primary key, "
+            u"	team_id     varchar, "
+            u"	color       varchar, "
+            u"	card_id     integer, "
             u"	text        varchar, "
             u"	user_id     varchar, "
-            u"	user_name   varchar  "
+            u"	user_name   varchar, "
+            u"	revised_at  integer  "
             u")")
+        self.connection.execute(
+            u"create index if not exists card_revisions_card "
+            u"on card_revisions (team_id, color, card_id, revision)")
+        self.connection.execute(
+            u"create table if not exists card_tombstones ("
+            u"	team_id     varchar, "
+            u"	color       varchar, "
+            u"	card_id     integer, "
+            u"	user_id     varchar, "
+            u"	user_name   varchar, "
+            u"	removed_at  integer, "
+            u"	primary key (team_id, color, card_id)"
+            u") without rowid")
+
+    def __create_revision_triggers(self):
+        for card_class in (BlackCard, WhiteCard):
+            table = card_class.TABLE
+            self.connection.execute(
+                u"create trigger if not exists "+table+u"_revision after update of text on "+table+u" "
+                u"when old.text is not new.text "
+                u"begin "
+                u"	insert into card_revisions (team_id, color, card_id, text, user_id, user_name, revised_at) "
+                u"		values (old.team_id, '"+card_class.COLOR+u"', old.id, old.text, old.user_id, old.user_name, strftime('%s', 'now')); "
+                u"end")
+
+    # Removing a card (adding its tombstone) takes it out of the slots,
+    # stats and duplicate check, and bumps the version; the search
+    # index does the same in __create_search_index.
+    def __create_removal(self):
+        for card_class in (BlackCard, WhiteCard):
+            table = card_class.TABLE
+            color = card_class.COLOR
+            self.connection.execute(
+                u"create trigger if not exists card_tombstones_"+color+u" after insert on card_tombstones "
+                u"when new.color='"+color+u"' "
+                u"begin "+self.__remove_slot_sql(card_class, u"new.team_id", u"new.card_id")+
+                u"	update card_stats set count=count-1 where team_id=new.team_id and color='"+color+u"' "
+                u"		and user_id=(select ifnull(user_id, '') from "+table+u" "
+                u"			where team_id=new.team_id and id=new.card_id); "
+                u"	delete from card_stats where team_id=new.team_id and color='"+color+u"' and count<=0; "
+                u"	update "+table+u" set norm_text=null where team_id=new.team_id and id=new.card_id; "
+                u"	update config set value=value+1 where team_id=new.team_id and name='version'; "
+                u"end")
+
+    # SQL condition that 'card_table', a card table's alias in the
+    # query, refers to a card that hasn't been removed. An index lookup
+    # per row, on the tombstones' primary key.
+    @staticmethod
+    def live(card_class, card_table):
+        return (u"not exists (select 1 from card_tombstones t "
+                u"where t.team_id="+card_table+u".team_id and t.color='"+card_class.COLOR+u"' "
+                u"and t.card_id="+card_table+u".id)")
+
+    # Recount this deck's card_stats from scratch.
+    def rebuild_stats(self):
+        self.connection.execute(u"delete from card_stats where team_id=?", (self.name,))
+        self.__count_stats()
+        self.connection.commit()
+
+    def __count_stats(self):
+        cursor = self.connection.cursor()
+        for card_class in (BlackCard, WhiteCard):
+            cursor.execute(u"insert into card_stats (team_id, color, user_id, user_name, count) "
+                           u"select team_id, '"+card_class.COLOR+u"', ifnull(user_id, ''), user_name, count(*) "
+                           u"from "+card_class.TABLE+u" c where c.team_id=? and "+self.live(card_class, u"c")+u" "
+                           u"group by ifnull(user_id, '')", (self.name,))
+
+    # Full-text index over card text, using the FTS5 trigram tokenizer
+    # so that "match" keeps the substring semantics of the old
+    # "like '%text%'" search. One index per color serves every team in
+    # the file: a card's rowid there is its team's number times
+    # search_team_span plus its id, so a team's cards are one rowid
+    # range. Contentless, since the card tables aren't keyed by a single
+    # rowid; deletes pass the old text back in. Returns False if this
+    # SQLite build can't provide it, in which case search falls back to
+    # a table scan.
+    def __create_search_index(self, card_class):
+        index = card_class.SEARCH_TABLE
+        try:
+            self.connection.execute(
+                u"create virtual table if not exists "+index+u" using fts5("
+                u"	text, content='', tokenize='trigram'"
+                u")")
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    # SQL for the search index rowid of the card 'row' (new, old or an
+    # alias in the query).
+    def __search_rowid(self, row):
+        return (u"(select number from teams where team_id="+row+u".team_id) * "
+                u"{0:d} + ".format(search_team_span)+row+u".id")
+
+    def __create_search_triggers(self, card_class):
+        table = card_class.TABLE
+        index = card_class.SEARCH_TABLE
+        rowid = self.__search_rowid
+        self.connection.execute(
+            u"create trigger if not exists "+index+u"_insert after insert on "+table+u" "
+            u"begin "
+            u"	insert into "+index+u" (rowid, text) values ("+rowid(u"new")+u", new.text); "
+            u"end")
+        self.connection.execute(
+            u"create trigger if not exists "+index+u"_delete after delete on "+table+u" "
+            u"begin "
+            u"	insert into "+index+u" ("+index+u", rowid, text) values ('delete', "+rowid(u"old")+u", old.text); "
+            u"end")
+        self.connection.execute(
+            u"create trigger if not exists "+index+u"_update after update of text on "+table+u" "
+            u"begin "
+            u"	insert into "+index+u" ("+index+u", rowid, text) values ('delete', "+rowid(u"old")+u", old.text); "
+            u"	insert into "+index+u" (rowid, text) values ("+rowid(u"new")+u", new.text); "
+            u"end")
+        self.connection.execute(
+            u"create trigger if not exists "+index+u"_remove after insert on card_tombstones "
+            u"when new.color='"+card_class.COLOR+u"' "
+            u"begin "
+            u"	insert into "+index+u" ("+index+u", rowid, text) "
+            u"		select 'delete', "+rowid(u"c")+u", c.text from "+table+u" c "
+            u"		where c.team_id=new.team_id and c.id=new.card_id; "
+            u"end")
+
+    # Bounds of this deck's rowids in the search indexes, for a card id
+    # range (after_id, last].
+    def __search_range(self, after_id=0):
+        return (self.search_base + after_id + 1, self.search_base + search_team_span - 1)
 
     def get_config_item(self, name):
         cursor = self.connection.cursor()
-        cursor.execute(u"select value from config where name=?", (name,))
+        cursor.execute(u"select value from config where team_id=? and name=?", (self.name, name))
         value = None
         for row in cursor:
             value = row[0]
         return value
 
+    @retry_on_busy
     def set_config_item(self, name, value):
         cursor = self.connection.cursor()
-        cursor.execute(u"insert or replace into config (name, value) values (?,?)", (name, value))
+        cursor.execute(u"insert or replace into config (team_id, name, value) values (?,?,?)", (self.name, name, value))
+        self.connection.commit()
+        response_cache.invalidate(self.name)
+
+    def get_config_option(self, name):
+        value = self.get_config_item(name)
+        if (value is None or not value in config_options[name]):
+            return config_options[name][0]
+        return value
+
+    # The ways of drawing cards, by "draw_mode" setting. Each takes
+    # (card_class, count, processor, exclude) and returns 'count'
+    # distinct cards, none of them with an id in 'exclude', built from
+    # (text, user_id, user_name, id) rows by 'processor'.
+    def __draw_strategies(self):
+        return { u"random": self.__draw_random,
+                 u"bag": self.__draw_from_bag,
+                 u"newer": self.__draw_newer,
+                 u"rotate": self.__draw_least_recent,
+                 u"authors": self.__draw_by_author }
+
+    def __draw(self, card_class, count, processor, exclude=()):
+        strategy = self.__draw_strategies()[self.get_config_option(u"draw_mode")]
+        cards = strategy(card_class, count, processor, exclude)
+        self.__record_draws(card_class, cards)
+        return cards
+
+    def __record_draws(self, card_class, cards):
+        now = int(time.time())
+        drawn = self.drawn[card_class]
+        for card in cards:
+            previous = drawn.get(card.card_id)
+            drawn[card.card_id] = (now, previous[1] + 1 if previous else 1)
+        if (self.drawn_since is None):
+            self.drawn_since = timer()
+        if (len(self.drawn[BlackCard]) + len(self.drawn[WhiteCard]) >= draw_flush_size
+                or timer() - self.drawn_since >= draw_flush_interval):
+            self.flush_draws()
+
+    # Write out the draws counted since the last flush, in one
+    # transaction.
+    @retry_on_busy
+    def flush_draws(self):
+        if (self.drawn_since is None):
+            return
+        for card_class in (BlackCard, WhiteCard):
+            self.connection.executemany(
+                u"update "+card_class.TABLE+u" "
+                u"set last_drawn=?, draw_count=ifnull(draw_count, 0)+? where team_id=? and id=?",
+                [ (last, count, self.name, card_id) for (card_id, (last, count)) in self.drawn[card_class].items() ])
         self.connection.commit()
+        for drawn in self.drawn.values():
+            drawn.clear()
+        self.drawn_since = None
+
+    def __draw_random(self, card_class, count, processor, exclude=(), retry=True):
+        cached = self.__cached()
+        if (cached is not None):
+            return cached.draw(card_class, count, exclude)
 
-    def __draw(self, table, count, processor):
         cursor = self.connection.cursor()
-        # "ORDER BY RANDOM() LIMIT 1" isn't good for performance,
-        # but my thought is that the sample size will be low enough
-        # that I'm choosing not to worry about this now.
-        cursor.execute(u"select text, user_id, user_name, id from "+table+u" order by RANDOM() limit ?", str(count))
-        result = processor(cursor);
-        if (len(result) != count):
+        cursor.execute(u"select max(slot) from "+card_class.SLOT_TABLE+u" where team_id=?", (self.name,))
+        size = cursor.fetchone()[0] or 0
+        if (size < count):
             raise SlackError(u"Not enough cards!")
-        return result
 
-    def draw_black(self):
-        return self.__draw(u"black_cards", 1, self.__cursor_to_black_cards)[0]
+        # Sample enough extra slots that dropping the excluded cards
+        # still leaves 'count'.
+        slots = random_slots(size, min(size, count + len(exclude)))
+        cursor.execute(
+            u"select s.slot, c.text, c.user_id, c.user_name, c.id "
+            u"from "+card_class.SLOT_TABLE+u" s join "+card_class.TABLE+u" c "
+            u"on c.team_id=s.team_id and c.id=s.card_id "
+            u"where s.team_id=? and s.slot in ("+u",".join(u"?" * len(slots))+u")", [self.name] + slots)
+        rows = {}
+        for row in cursor:
+            rows[row[0]] = row[1:]
+
+        if (len(rows) != len(slots)):
+            # The slot table has drifted from the card table (e.g. it was
+            # edited by hand with the triggers missing). Rebuild and retry.
+            if not retry:
+                raise SlackError(u"Not enough cards!")
+            self.__rebuild_slots(card_class)
+            return self.__draw_random(card_class, count, processor, exclude, retry=False)
+
+        # Keep the order the slots were sampled in, not id order.
+        rows = [ rows[slot] for slot in slots if not rows[slot][3] in exclude ]
+        if (len(rows) < count):
+            raise SlackError(u"Not enough cards!")
+        return processor(rows[0:count])
+
+    # Refill the bag with a fresh shuffle of the whole deck. Returns the
+    # new [cursor, size, max_id].
+    def __shuffle_bag(self, card_class):
+        cursor = self.connection.cursor()
+        cursor.execute(u"delete from "+card_class.BAG_TABLE+u" where team_id=?", (self.name,))
+        cursor.execute(u"select id from "+card_class.TABLE+u" c "
+                       u"where c.team_id=? and "+self.live(card_class, u"c"), (self.name,))
+        ids = [ row[0] for row in cursor.fetchall() ]
+        random.shuffle(ids)
+        cursor.executemany(u"insert into "+card_class.BAG_TABLE+u" (team_id, position, card_id) values (?,?,?)",
+                           [ (self.name, position + 1, card_id) for (position, card_id) in enumerate(ids) ])
+        return [1, len(ids), max(ids) if ids else 0]
+
+    # Cards added since the bag was shuffled go into a random position
+    # among the ones not dealt yet (the card there moves to the end), so
+    # they turn up this time round without reshuffling everything.
+    def __merge_into_bag(self, card_class, state):
+        bag = card_class.BAG_TABLE
+        cursor = self.connection.cursor()
+        cursor.execute(u"select id from "+card_class.TABLE+u" c "
+                       u"where c.team_id=? and c.id>? and "+self.live(card_class, u"c")+u" order by id",
+                       (self.name, state[2]))
+        for (card_id,) in cursor.fetchall():
+            state[1] += 1
+            position = random.randint(state[0], state[1])
+            if (position != state[1]):
+                cursor.execute(u"update "+bag+u" set position=? where team_id=? and position=?",
+                               (state[1], self.name, position))
+            cursor.execute(u"insert into "+bag+u" (team_id, position, card_id) values (?,?,?)",
+                           (self.name, position, card_id))
+            state[2] = card_id
+
+    @retry_on_busy
+    def __draw_from_bag(self, card_class, count, processor, exclude=()):
+        cursor = self.connection.cursor()
+        cursor.execute(u"select max(slot) from "+card_class.SLOT_TABLE+u" where team_id=?", (self.name,))
+        if ((cursor.fetchone()[0] or 0) < count):
+            raise SlackError(u"Not enough cards!")
 
-    def draw_whites(self, count=1):
-        return self.__draw(u"white_cards", count, self.__cursor_to_white_cards)
+        # Take the write lock up front so two processes can't deal the
+        # same stretch of the bag.
+        self.connection.commit()
+        cursor.execute(u"begin immediate")
+
+        cursor.execute(u"select cursor, size, max_id from bag_state where team_id=? and color=?",
+                       (self.name, card_class.COLOR))
+        state = cursor.fetchone()
+        if (state is None):
+            state = self.__shuffle_bag(card_class)
+        else:
+            state = list(state)
+        self.__merge_into_bag(card_class, state)
+
+        rows = []
+        # Excluded cards are passed over like deleted ones.
+        taken = set(exclude)
+        reshuffled = False
+        while (len(rows) < count):
+            wanted = count - len(rows)
+            # Left join: positions whose card has since been deleted or
+            # removed are passed over, but still advance the cursor.
+            cursor.execute(
+                u"select b.position, c.text, c.user_id, c.user_name, c.id "
+                u"from "+card_class.BAG_TABLE+u" b left join "+card_class.TABLE+u" c "
+                u"on c.team_id=b.team_id and c.id=b.card_id and "+self.live(card_class, u"c")+u" "
+                u"where b.team_id=? and b.position>=? order by b.position limit ?",
+                (self.name, state[0], wanted))
+            fetched = cursor.fetchall()
+            for row in fetched:
+                state[0] = row[0] + 1
+                if (row[4] is None or row[4] in taken):
+                    continue
+                taken.add(row[4])
+                rows.append(row[1:])
+
+            if (len(fetched) < wanted and len(rows) < count):
+                # Bag exhausted; start over with a new shuffle.
+                if reshuffled:
+                    raise SlackError(u"Not enough cards!")
+                state = self.__shuffle_bag(card_class)
+                reshuffled = True
+
+        cursor.execute(u"insert or replace into bag_state (team_id, color, cursor, size, max_id) values (?,?,?,?,?)",
+                       (self.name, card_class.COLOR, state[0], state[1], state[2]))
+        self.connection.commit()
+        return processor(rows)
+
+    # Ids of the deck's cards in id order, with the running total of
+    # their weights under 'weigh' (one of the *_weights functions), so
+    # a weighted draw is a binary search per card. Rebuilt whenever the
+    # deck's version changes.
+    def __weights(self, card_class, weigh):
+        version = self.get_config_item(u"version")
+        key = (card_class, weigh)
+        entry = self.weight_tables.get(key)
+        if (entry is None or entry[0] != version):
+            cursor = self.connection.cursor()
+            cursor.execute(u"select c.id, ifnull(c.user_id, '') "
+                           u"from "+card_class.SLOT_TABLE+u" s join "+card_class.TABLE+u" c "
+                           u"on c.team_id=s.team_id and c.id=s.card_id "
+                           u"where s.team_id=? order by c.id", (self.name,))
+            rows = cursor.fetchall()
+            ids = array('l', [ row[0] for row in rows ])
+            totals = array('d')
+            total = 0.0
+            for weight in weigh(rows):
+                total += weight
+                totals.append(total)
+            entry = self.weight_tables[key] = (version, ids, totals)
+        return entry
+
+    def __draw_weighted(self, card_class, count, processor, exclude, weigh, retry=True):
+        (_, ids, totals) = self.__weights(card_class, weigh)
+        if (len(ids) < count):
+            raise SlackError(u"Not enough cards!")
+
+        # Draw with replacement and throw back repeats. The weights are
+        # within a small factor of each other, so this rarely takes many
+        # more tries than cards, but give up before looping forever when
+        # 'exclude' covers most of the deck.
+        chosen = []
+        taken = set(exclude)
+        tries = 20 * (count + len(exclude))
+        while (len(chosen) < count):
+            if (tries == 0):
+                raise SlackError(u"Not enough cards!")
+            tries -= 1
+            position = bisect.bisect_right(totals, random.random() * totals[-1])
+            card_id = ids[min(position, len(ids) - 1)]
+            if not card_id in taken:
+                taken.add(card_id)
+                chosen.append(card_id)
+
+        cursor = self.connection.cursor()
+        cursor.execute(u"select text, user_id, user_name, id from "+card_class.TABLE+u" "
+                       u"where team_id=? and id in ("+u",".join(u"?" * len(chosen))+u")", [self.name] + chosen)
+        rows = {}
+        for row in cursor:
+            rows[row[3]] = row
+        if (len(rows) != len(chosen)):
+            # Cards deleted by hand, without a version bump.
+            if not retry:
+                raise SlackError(u"Not enough cards!")
+            self.weight_tables.clear()
+            return self.__draw_weighted(card_class, count, processor, exclude, weigh, retry=False)
+        return processor([ rows[card_id] for card_id in chosen ])
+
+    def __draw_newer(self, card_class, count, processor, exclude=()):
+        return self.__draw_weighted(card_class, count, processor, exclude, newer_weights)
+
+    def __draw_by_author(self, card_class, count, processor, exclude=()):
+        return self.__draw_weighted(card_class, count, processor, exclude, author_weights)
+
+    # Cards that haven't been drawn for longest, never-drawn ones first,
+    # read off the last_drawn index. The cards dealt are picked at
+    # random from twice as many candidates, so that the order isn't
+    # predictable. Cards drawn since the last flush are passed over.
+    # Removed cards keep their place in the index and are skipped.
+    def __draw_least_recent(self, card_class, count, processor, exclude=()):
+        pending = self.drawn[card_class]
+        cursor = self.connection.cursor()
+        cursor.execute(u"select text, user_id, user_name, id from "+card_class.TABLE+u" c "
+                       u"where c.team_id=? and "+self.live(card_class, u"c")+u" order by last_drawn limit ?",
+                       (self.name, 2 * count + len(exclude) + len(pending)))
+        rows = [ row for row in cursor if not row[3] in exclude and not row[3] in pending ]
+        if (len(rows) < count and pending):
+            # The whole deck has come up since the last flush; write the
+            # draws out so that their order is known.
+            self.flush_draws()
+            return self.__draw_least_recent(card_class, count, processor, exclude)
+        if (len(rows) < count):
+            raise SlackError(u"Not enough cards!")
+        return processor(random.sample(rows[0:2 * count], count))
 
-    def __find_existing(self, table, text):
+    def draw_black(self):
+        return self.__draw(BlackCard, 1, self.__cursor_to_black_cards)[0]
+
+    def draw_whites(self, count=1, exclude=()):
+        return self.__draw(WhiteCard, count, self.__cursor_to_white_cards, exclude)
+
+    # 'count' rounds at once: one draw for all the black cards and one
+    # for all the white cards they need, so no card appears twice.
+    # Returns a list of (black_card, white_cards) tuples.
+    def draw_rounds(self, count):
+        black_cards = self.__draw(BlackCard, count, self.__cursor_to_black_cards)
+        picks = [ b.get_pick_count() for b in black_cards ]
+        white_cards = self.__draw(WhiteCard, sum(picks), self.__cursor_to_white_cards)
+
+        rounds = []
+        top_card = 0
+        for (black_card, pick) in zip(black_cards, picks):
+            rounds.append((black_card, white_cards[top_card:top_card + pick]))
+            top_card += pick
+        return rounds
+
+    def __find_existing(self, card_class, norm_text):
         cursor = self.connection.cursor()
-        cursor.execute(u"select id from "+table+u" where upper(text)=upper(?)", (text,))
+        cursor.execute(u"select id from "+card_class.TABLE+u" where team_id=? and norm_text=?", (self.name, norm_text))
         row = cursor.fetchone()
         if (row is None):
             return None
         else:
             return row[0]
 
+    def __already_exists(self, card, existing_id):
+        if (existing_id is None):
+            return SlackError(u"Card already exists.")
+        return SlackError(u"Card already exists (as {0}{1}).".format(card.ID_PREFIX, existing_id))
+
+    @retry_on_busy
     def save(self, card):
-        existing_id = self.__find_existing(card.TABLE, card.text)
+        norm_text = normalize_card_text(card.text)
+        existing_id = self.__find_existing(type(card), norm_text)
         if (not existing_id is None and existing_id != card.card_id):
-            raise SlackError(u"Card already exists (as {0}{1}).".format(card.ID_PREFIX, existing_id))
+            raise self.__already_exists(card, existing_id)
 
+        # Existing cards are updated in place rather than with "insert or
+        # replace", which would delete the old row without running the
+        # delete triggers that keep the search index in sync.
         cursor = self.connection.cursor()
-        cursor.execute(u"insert or replace into "+card.TABLE+" (id, text, user_id, user_name) values (?,?,?,?)", (
-                           card.card_id,
-                           card.text,
-                           card.author.id,
-                           card.author.name))
-        card.card_id = cursor.lastrowid
+        try:
+            if (card.card_id is not None):
+                cursor.execute(u"update "+card.TABLE+u" set text=?, norm_text=?, user_id=?, user_name=? where team_id=? and id=?", (
+                                   card.text,
+                                   norm_text,
+                                   card.author.id,
+                                   card.author.name,
+                                   self.name,
+                                   card.card_id))
+            if (card.card_id is None):
+                # Ids count up per team; the write lock taken by the
+                # insert keeps the "max" ours until the commit.
+                cursor.execute(u"insert into "+card.TABLE+u" (team_id, id, text, norm_text, user_id, user_name) "
+                               u"select ?, ifnull(max(id), 0) + 1, ?, ?, ?, ? from "+card.TABLE+u" where team_id=?", (
+                                   self.name,
+                                   card.text,
+                                   norm_text,
+                                   card.author.id,
+                                   card.author.name,
+                                   self.name))
+                cursor.execute(u"select max(id) from "+card.TABLE+u" where team_id=?", (self.name,))
+                card.card_id = cursor.fetchone()[0]
+            elif (cursor.rowcount == 0):
+                cursor.execute(u"insert into "+card.TABLE+u" (team_id, id, text, norm_text, user_id, user_name) values (?,?,?,?,?,?)", (
+                                   self.name,
+                                   card.card_id,
+                                   card.text,
+                                   norm_text,
+                                   card.author.id,
+                                   card.author.name))
+        except sqlite3.IntegrityError:
+            # Someone else saved the same text since we checked.
+            self.connection.rollback()
+            raise self.__already_exists(card, self.__find_existing(type(card), norm_text))
         self.connection.commit()
+        response_cache.invalidate(self.name)
+        if deck_cache_enabled:
+            deck_cache.card_saved(self, card)
         return card.card_id
 
-    def get_status(self):
+    # Remove a card. It stays in the database, with a tombstone saying
+    # who removed it, but is no longer drawn, found or counted.
+    @retry_on_busy
+    def remove(self, card, author):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(u"insert into card_tombstones "
+                           u"(team_id, color, card_id, user_id, user_name, removed_at) "
+                           u"values (?,?,?,?,?,strftime('%s', 'now'))",
+                           (self.name, card.COLOR, card.card_id, author.id, author.name))
+        except sqlite3.IntegrityError:
+            # Someone else removed it first.
+            self.connection.rollback()
+            raise card_id_error(card.get_id_str())
+        self.connection.commit()
+        response_cache.invalidate(self.name)
+
+    @retry_on_busy
+    def __delete_revisions(self, revisions):
+        self.connection.executemany(u"delete from card_revisions where revision=?",
+                                    [ (r,) for r in revisions ])
+        self.connection.commit()
+
+    # Purge all but the newest 'keep' revisions of every card. Works
+    # through the revisions in batches of 'batch_size', each deleted in
+    # its own short transaction, so a big deck is never locked for long.
+    # Returns the number of revisions purged.
+    def compact_revisions(self, keep=10, batch_size=500):
+        cursor = self.connection.cursor()
+        purged = 0
+        last = 0
+        while True:
+            cursor.execute(
+                u"select r.revision from card_revisions r where r.revision>? and r.team_id=? and ("
+                u"	select count(*) from card_revisions n "
+                u"	where n.team_id=r.team_id and n.color=r.color and n.card_id=r.card_id and n.revision>r.revision"
+                u") >= ? order by r.revision limit ?", (last, self.name, keep, batch_size))
+            batch = [ row[0] for row in cursor.fetchall() ]
+            if (len(batch) == 0):
+                return purged
+            self.__delete_revisions(batch)
+            purged += len(batch)
+            last = batch[-1]
+
+    # This deck's entry in the deck cache, loaded or reloaded as needed;
+    # None if the cache is off or the deck doesn't fit in it, in which
+    # case callers go to the database.
+    def __cached(self):
+        if not deck_cache_enabled:
+            return None
+        return deck_cache.get(self)
+
+    # The deck in memory, or None as soon as it turns out to take more
+    # than 'max_bytes'.
+    def load_cached(self, version, max_bytes):
+        cached = CachedDeck(version)
         cursor = self.connection.cursor()
-        cursor.execute(u"select count(*) from white_cards");
-        white_card_count = cursor.fetchone()[0]
-        cursor.execute(u"select count(*) from black_cards");
-        black_card_count = cursor.fetchone()[0]
+        for card_class in (BlackCard, WhiteCard):
+            cursor.execute(u"select id, text, user_id, user_name from "+card_class.TABLE+u" c "
+                           u"where c.team_id=? and "+self.live(card_class, u"c")+u" order by id", (self.name,))
+            for (card_id, text, user_id, user_name) in cursor:
+                cached.add(card_class, card_id, text, user_id, user_name)
+                if (cached.size > max_bytes):
+                    cursor.close()
+                    return None
+        return cached
 
+    def get_status(self):
+        cursor = self.connection.cursor()
+        totals = {'black':0,'white':0}
         authors = {}
-        cursor.execute(u"select user_name, count(*) from black_cards group by user_id");
-        for row in cursor:
-            (user_name, count) = row
-            if (not user_name in authors):
-                authors[user_name] = {'black':0,'white':0}
-            authors[user_name]['black'] = count;
-        cursor.execute(u"select user_name, count(*) from white_cards group by user_id");
+        cursor.execute(u"select color, user_name, count from card_stats where team_id=? order by color, user_id", (self.name,));
         for row in cursor:
-            (user_name, count) = row
+            (color, user_name, count) = row
+            totals[color] += count
             if (not user_name in authors):
                 authors[user_name] = {'black':0,'white':0}
-            authors[user_name]['white'] = count;
+            authors[user_name][color] = count;
 
-        return DeckStatus(white_card_count=white_card_count,
-                          black_card_count=black_card_count,
+        return DeckStatus(white_card_count=totals['white'],
+                          black_card_count=totals['black'],
                           authors=authors)
 
     def get_black_card(self, numeric_id):
+        cached = self.__cached()
+        if (cached is not None):
+            return cached.get(BlackCard, numeric_id)
+
         cursor = self.connection.cursor()
-        cursor.execute(Deck.BLACK_SELECT + u" where id=?", (numeric_id,))
+        cursor.execute(u"select text, user_id, user_name, id from "+BlackCard.TABLE+u" c "
+                       u"where c.team_id=? and c.id=? and "+self.live(BlackCard, u"c"), (self.name, numeric_id))
         results = self.__cursor_to_black_cards(cursor)
         if (len(results) < 1):
             return None
@@ -298,8 +1690,13 @@ class Deck:
             return results[0]
 
     def get_white_card(self, numeric_id):
+        cached = self.__cached()
+        if (cached is not None):
+            return cached.get(WhiteCard, numeric_id)
+
         cursor = self.connection.cursor()
-        cursor.execute(Deck.WHITE_SELECT + u" where id=?", (numeric_id,))
+        cursor.execute(u"select text, user_id, user_name, id from "+WhiteCard.TABLE+u" c "
+                       u"where c.team_id=? and c.id=? and "+self.live(WhiteCard, u"c"), (self.name, numeric_id))
         results = self.__cursor_to_white_cards(cursor)
         if (len(results) < 1):
             return None
@@ -307,62 +1704,603 @@ class Deck:
             return results[0]
 
     def get_card_by_id(self, card_id):
-        if (card_id is None or card_id == u""):
-            raise SlackError(u"Card id was empty.")
-        pattern = re.compile("^([BW])([0-9]+)$")
-        card_id = card_id.upper()
-        match = pattern.match(card_id)
-        if not match:
-            raise SlackError(u"Invalid card id '{0}'".format(card_id))
-
-        if (match.group(1) == 'B'):
-            card = self.get_black_card(int(match.group(2)))
+        parsed = parse_card_id(card_id)
+        if (parsed is None):
+            raise card_id_error(card_id)
+
+        if (parsed[0] is BlackCard):
+            card = self.get_black_card(parsed[1])
         else:
-            card = self.get_white_card(int(match.group(2)))
+            card = self.get_white_card(parsed[1])
 
         if not card:
-            raise SlackError(u"Card '{0}' not found.".format(card_id))
+            raise card_id_error(card_id)
         else:
             return card
 
+    # Cards for a list of ids, in the same order, looked up with one
+    # query per color. Ids that are malformed or not in the deck give
+    # None; card_id_error says what was wrong with them.
+    def get_cards_by_id(self, card_ids):
+        parsed = [ parse_card_id(card_id) for card_id in card_ids ]
+        found = {}
+        for card_class in (BlackCard, WhiteCard):
+            numbers = sorted(set(p[1] for p in parsed if p is not None and p[0] is card_class))
+            cached = self.__cached() if numbers else None
+            for start in xrange(0, len(numbers), 500):
+                chunk = numbers[start:start + 500]
+                if (cached is not None):
+                    cards = [ cached.get(card_class, number) for number in chunk ]
+                else:
+                    cursor = self.connection.cursor()
+                    cursor.execute(u"select text, user_id, user_name, id from "+card_class.TABLE+u" c "
+                                   u"where c.team_id=? and c.id in ("+u",".join(u"?" * len(chunk))+u") "
+                                   u"and "+self.live(card_class, u"c"), [self.name] + chunk)
+                    cards = self.__iter_rows(card_class, cursor)
+                for card in cards:
+                    if (card is not None):
+                        found[(card_class, card.card_id)] = card
+        return [ found.get(p) if p is not None else None for p in parsed ]
+
+    def __author(self, user_id, user_name):
+        key = (user_id, user_name)
+        author = self.authors.get(key)
+        if (author is None):
+            if (len(self.authors) >= max_interned_authors):
+                self.authors.clear()
+            author = self.authors[key] = User(id=user_id, name=user_name)
+        return author
+
+    def __row_to_card(self, card_class, row):
+        (text, user_id, user_name, card_id) = row
+        return card_class(text=text,
+                          author=self.__author(user_id, user_name),
+                          card_id=card_id)
+
+    # Cards built from (text, user_id, user_name, id) rows as they are
+    # consumed, so a caller can stop early without reading the rest.
+    def __iter_rows(self, card_class, rows):
+        for row in rows:
+            yield self.__row_to_card(card_class, row)
+
     def __cursor_to_white_cards(self, cursor):
-        results = []
-        for row in cursor:
-            (text, user_id, user_name, card_id) = row
-            results.append(WhiteCard(text=text,
-                                     author=User(id=user_id, name=user_name),
-                                     card_id=card_id))
-        return results
+        return list(self.__iter_rows(WhiteCard, cursor))
 
     def __cursor_to_black_cards(self, cursor):
-        results = []
-        for row in cursor:
-            (text, user_id, user_name, card_id) = row
-            results.append(BlackCard(text=text,
-                                     author=User(id=user_id, name=user_name),
-                                     card_id=card_id))
-        return results
-
-    def search(self, text):
-        text = "%" + text + "%"
-        cursor = self.connection.cursor()
-        cards = [];
-        cursor.execute(Deck.BLACK_SELECT + u" where text like ?", (text,));
-        cards += self.__cursor_to_black_cards(cursor);
-        cursor.execute(Deck.WHITE_SELECT + u" where text like ?", (text,));
-        cards += self.__cursor_to_white_cards(cursor);
-        return cards
+        return list(self.__iter_rows(BlackCard, cursor))
 
-    def dump(self):
+    # The trigram index can't match anything shorter than three
+    # characters, so short searches scan the table instead.
+    def __use_search_index(self, text):
+        return self.search_index and len(text) >= 3
+
+    # Rows of (text, user_id, user_name, id, rank), best match first.
+    def __search_rows(self, card_class, text, limit):
+        cursor = self.connection.cursor()
+        if self.__use_search_index(text):
+            (first, last) = self.__search_range()
+            cursor.execute(
+                u"select c.text, c.user_id, c.user_name, c.id, s.rank from ("
+                u"	select rowid, rank from "+card_class.SEARCH_TABLE+u" "
+                u"	where "+card_class.SEARCH_TABLE+u" match ? and rowid between ? and ? order by rank limit ?"
+                u") s join "+card_class.TABLE+u" c on c.team_id=? and c.id=s.rowid-? order by s.rank",
+                (search_phrase(text), first, last, limit, self.name, self.search_base))
+        else:
+            cursor.execute(
+                u"select text, user_id, user_name, id, 0 from "+card_class.TABLE+u" c "
+                u"where c.team_id=? and text like ? and "+self.live(card_class, u"c")+u" limit ?",
+                (self.name, u"%" + text + u"%", limit))
+        return cursor.fetchall()
+
+    # Cards containing 'text', best match first, at most 'limit' of them.
+    def search(self, text, limit=None):
+        if (limit is None):
+            limit = -1
+        ranked = []
+        for card_class in (BlackCard, WhiteCard):
+            rows = self.__search_rows(card_class, text, limit)
+            ranked += [ (row[4], row[0:4], card_class) for row in rows ]
+
+        # Stable sort, so black cards still come first on a tie. Cards
+        # are only built for the rows that make the cut.
+        ranked.sort(key=lambda x: x[0])
+        if (limit >= 0):
+            ranked = ranked[0:limit]
+        return [ self.__row_to_card(card_class, row)
+                 for (_, row, card_class) in ranked ]
+
+    # Rows of (text, user_id, user_name, id) with id > 'after_id', in id
+    # order, at most 'limit' of them.
+    def __search_page_rows(self, card_class, text, after_id, limit):
+        cursor = self.connection.cursor()
+        if self.__use_search_index(text):
+            (first, last) = self.__search_range(after_id)
+            cursor.execute(
+                u"select c.text, c.user_id, c.user_name, c.id from "+card_class.SEARCH_TABLE+u" s "
+                u"join "+card_class.TABLE+u" c on c.team_id=? and c.id=s.rowid-? "
+                u"where "+card_class.SEARCH_TABLE+u" match ? and s.rowid between ? and ? "
+                u"order by s.rowid limit ?",
+                (self.name, self.search_base, search_phrase(text), first, last, limit))
+        else:
+            cursor.execute(
+                u"select text, user_id, user_name, id from "+card_class.TABLE+u" c "
+                u"where c.team_id=? and text like ? and id > ? and "+self.live(card_class, u"c")+u" order by id limit ?",
+                (self.name, u"%" + text + u"%", after_id, limit))
+        return cursor.fetchall()
+
+    # One page of cards containing 'text', black cards first and then
+    # by id, starting after 'after' (a (card class, id) pair, or None
+    # for the first page). Returns the cards and whether there are more.
+    def search_page(self, text, after=None, limit=4):
+        rows = []
+        for card_class in (BlackCard, WhiteCard):
+            after_id = 0
+            if (after is not None):
+                if (after[0] is WhiteCard and card_class is BlackCard):
+                    continue
+                if (after[0] is card_class):
+                    after_id = after[1]
+            # One extra row tells us whether there's another page.
+            wanted = limit + 1 - len(rows)
+            if (wanted <= 0):
+                break
+            rows += [ (card_class, row)
+                      for row in self.__search_page_rows(card_class, text, after_id, wanted) ]
+
+        cards = [ self.__row_to_card(card_class, row) for (card_class, row) in rows[0:limit] ]
+        return (cards, len(rows) > limit)
+
+    def search_count(self, text):
         cursor = self.connection.cursor()
+        total = 0
+        for card_class in (BlackCard, WhiteCard):
+            if self.__use_search_index(text):
+                cursor.execute(
+                    u"select count(*) from "+card_class.SEARCH_TABLE+u" "
+                    u"where "+card_class.SEARCH_TABLE+u" match ? and rowid between ? and ?",
+                    (search_phrase(text),) + self.__search_range())
+            else:
+                cursor.execute(
+                    u"select count(*) from "+card_class.TABLE+u" c "
+                    u"where c.team_id=? and text like ? and "+self.live(card_class, u"c"),
+                    (self.name, u"%" + text + u"%"))
+            total += cursor.fetchone()[0]
+        return total
+
+    # Cards of one color in id order, read from the cursor as they are
+    # consumed rather than loaded up front.
+    def iter_cards(self, card_class):
+        cursor = self.connection.cursor()
+        cursor.execute(u"select text, user_id, user_name, id from "+card_class.TABLE+u" c "
+                       u"where c.team_id=? and "+self.live(card_class, u"c")+u" order by id", (self.name,))
+        for card in self.__iter_rows(card_class, cursor):
+            yield card
+
+    def dump(self):
         database = {}
-        cursor.execute(Deck.BLACK_SELECT)
-        database['black_cards'] = map(lambda x: x.as_dict(), self.__cursor_to_black_cards(cursor))
-        cursor.execute(Deck.WHITE_SELECT)
-        database['white_cards'] = map(lambda x: x.as_dict(), self.__cursor_to_white_cards(cursor))
+        database['black_cards'] = [ c.as_dict() for c in self.iter_cards(BlackCard) ]
+        database['white_cards'] = [ c.as_dict() for c in self.iter_cards(WhiteCard) ]
 
         return database
 
+    # Flat records for cardtool's export; the same shape import_cards
+    # reads back in.
+    def export_cards(self):
+        for card_class in (BlackCard, WhiteCard):
+            for card in self.iter_cards(card_class):
+                yield { 'color': card_class.COLOR,
+                        'card_id': card.get_id_str(),
+                        'text': card.text,
+                        'user_id': card.author.id,
+                        'user_name': card.author.name }
+
+    def __import_row(self, record, author):
+        if not isinstance(record, dict):
+            return None
+        color = (record.get('color') or u"").strip().lower()
+        if (color == u"black"):
+            card_class = BlackCard
+        elif (color == u"white"):
+            card_class = WhiteCard
+        else:
+            return None
+        text = normalize_blanks((record.get('text') or u"").strip())
+        if (text == u""):
+            return None
+        return (card_class, (text,
+                             normalize_card_text(text),
+                             record.get('user_id') or author.id,
+                             record.get('user_name') or author.name))
+
+    def __import_batch(self, batch, result):
+        cursor = self.connection.cursor()
+        for card_class in (BlackCard, WhiteCard):
+            rows = batch[card_class]
+            if (len(rows) == 0):
+                continue
+            # The unique norm_text index drops duplicates, both of cards
+            # already in the deck and of earlier rows in the same import.
+            cursor.executemany(u"insert or ignore into "+card_class.TABLE+u" "
+                               u"(team_id, id, text, norm_text, user_id, user_name) "
+                               u"select ?, ifnull(max(id), 0) + 1, ?, ?, ?, ? from "+card_class.TABLE+u" where team_id=?",
+                               [ (self.name,) + row + (self.name,) for row in rows ])
+            result.inserted += cursor.rowcount
+            result.duplicates += len(rows) - cursor.rowcount
+            del rows[:]
+        self.connection.commit()
+
+    # Bulk load from an iterable of records (dicts with 'color', 'text'
+    # and optionally 'user_id'/'user_name'), committing every
+    # 'batch_size' cards. Records that can't be turned into a card are
+    # counted as skipped.
+    def import_cards(self, records, author, batch_size=1000):
+        result = ImportResult()
+        batch = { BlackCard: [], WhiteCard: [] }
+        pending = 0
+        for record in records:
+            row = self.__import_row(record, author)
+            if (row is None):
+                result.skipped += 1
+                continue
+            batch[row[0]].append(row[1])
+            pending += 1
+            if (pending >= batch_size):
+                self.__import_batch(batch, result)
+                pending = 0
+        self.__import_batch(batch, result)
+        return result
+
+    # Copy the cards (keeping their ids and history), settings and bag
+    # of 'source', another Deck, into this one, e.g. to move a deck to a
+    # different storage backend. This deck must not have any cards yet.
+    def copy_from(self, source):
+        cursor = self.connection.cursor()
+        cursor.execute(u"select exists (select 1 from "+BlackCard.TABLE+u" where team_id=?) "
+                       u"or exists (select 1 from "+WhiteCard.TABLE+u" where team_id=?)", (self.name, self.name))
+        if cursor.fetchone()[0]:
+            raise ValueError("deck {0} already has cards".format(self.name))
+        self.connection.commit()
+
+        # Inserting the cards runs the triggers, which fill in the
+        # slots, stats and search index as they go. Each query reads the
+        # source deck's rows and files them under this deck's name.
+        teams = (self.name, source.name)
+        cursor.execute(u"attach database ? as source", (source.path,))
+        try:
+            for card_class in (BlackCard, WhiteCard):
+                cursor.execute(u"insert into "+card_class.TABLE+u" "
+                               u"(team_id, id, text, norm_text, user_id, user_name, last_drawn, draw_count) "
+                               u"select ?, id, text, norm_text, user_id, user_name, last_drawn, draw_count "
+                               u"from source."+card_class.TABLE+u" where team_id=? order by id", teams)
+                cursor.execute(u"insert into "+card_class.BAG_TABLE+u" (team_id, position, card_id) "
+                               u"select ?, position, card_id from source."+card_class.BAG_TABLE+u" "
+                               u"where team_id=?", teams)
+            # After the cards, so the tombstone triggers find them.
+            cursor.execute(u"insert into card_tombstones "
+                           u"(team_id, color, card_id, user_id, user_name, removed_at) "
+                           u"select ?, color, card_id, user_id, user_name, removed_at "
+                           u"from source.card_tombstones where team_id=?", teams)
+            # Revision numbers are per file, so they're renumbered here,
+            # in the same order.
+            cursor.execute(u"insert into card_revisions "
+                           u"(team_id, color, card_id, text, user_id, user_name, revised_at) "
+                           u"select ?, color, card_id, text, user_id, user_name, revised_at "
+                           u"from source.card_revisions where team_id=? order by revision", teams)
+            # This deck's own version counter has already moved on.
+            cursor.execute(u"insert or replace into config (team_id, name, value) "
+                           u"select ?, name, value from source.config "
+                           u"where team_id=? and name!='version'", teams)
+            cursor.execute(u"insert or replace into bag_state (team_id, color, cursor, size, max_id) "
+                           u"select ?, color, cursor, size, max_id from source.bag_state "
+                           u"where team_id=?", teams)
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.execute(u"detach database source")
+
+# Whether the deck file open on 'connection' holds a deck for
+# 'team_id'. These functions read a file without going through Deck,
+# so they work on read-only connections (cardtool's analytics), but
+# raise sqlite3.OperationalError for files a Deck hasn't brought up to
+# date yet.
+def has_deck(connection, team_id):
+    cursor = connection.cursor()
+    cursor.execute(u"select 1 from teams where team_id=?", (team_id,))
+    return cursor.fetchone() is not None
+
+# Rows of (id, text, user_id, user_name, draw_count, last_drawn) for one
+# color of a team's deck, in id order, for cardtool's analytics export.
+# last_drawn is None for cards that have never been drawn.
+def draw_stats(connection, team_id, card_class):
+    cursor = connection.cursor()
+    cursor.execute(u"select id, text, user_id, user_name, ifnull(draw_count, 0), last_drawn "
+                   u"from "+card_class.TABLE+u" c "
+                   u"where c.team_id=? and "+Deck.live(card_class, u"c")+u" order by id", (team_id,))
+    for row in cursor:
+        yield row
+
+# A deck's cards held in memory: per color, the ids, texts and author
+# numbers in parallel arrays, plus an index from card id to position.
+# Cards handed out are new objects, so callers may change them.
+class CachedDeck(object):
+    # Rough per-card cost beyond the text itself: array items, the list
+    # slot and the id index entry.
+    CARD_OVERHEAD = 120
+
+    def __init__(self, version):
+        self.version = version
+        self.lock = threading.Lock()
+        self.authors = []
+        self.author_numbers = {}
+        self.ids = { BlackCard: array('l'), WhiteCard: array('l') }
+        self.texts = { BlackCard: [], WhiteCard: [] }
+        self.card_authors = { BlackCard: array('l'), WhiteCard: array('l') }
+        self.positions = { BlackCard: {}, WhiteCard: {} }
+        self.size = 0
+
+    def __author_number(self, user_id, user_name):
+        key = (user_id, user_name)
+        number = self.author_numbers.get(key)
+        if (number is None):
+            number = self.author_numbers[key] = len(self.authors)
+            self.authors.append(User(id=user_id, name=user_name))
+            self.size += CachedDeck.CARD_OVERHEAD
+        return number
+
+    # Add a card, or replace the one with the same id.
+    def add(self, card_class, card_id, text, user_id, user_name):
+        author = self.__author_number(user_id, user_name)
+        position = self.positions[card_class].get(card_id)
+        if (position is None):
+            self.positions[card_class][card_id] = len(self.texts[card_class])
+            self.ids[card_class].append(card_id)
+            self.texts[card_class].append(text)
+            self.card_authors[card_class].append(author)
+            self.size += CachedDeck.CARD_OVERHEAD + sys.getsizeof(text)
+        else:
+            self.size += sys.getsizeof(text) - sys.getsizeof(self.texts[card_class][position])
+            self.texts[card_class][position] = text
+            self.card_authors[card_class][position] = author
+
+    def __card(self, card_class, position):
+        return card_class(text=self.texts[card_class][position],
+                          author=self.authors[self.card_authors[card_class][position]],
+                          card_id=self.ids[card_class][position])
+
+    def get(self, card_class, card_id):
+        with self.lock:
+            position = self.positions[card_class].get(card_id)
+            if (position is None):
+                return None
+            return self.__card(card_class, position)
+
+    def draw(self, card_class, count, exclude=()):
+        with self.lock:
+            ids = self.ids[card_class]
+            size = len(ids)
+            if (size < count):
+                raise SlackError(u"Not enough cards!")
+            positions = [ slot - 1 for slot in random_slots(size, min(size, count + len(exclude)))
+                          if not ids[slot - 1] in exclude ]
+            if (len(positions) < count):
+                raise SlackError(u"Not enough cards!")
+            return [ self.__card(card_class, position) for position in positions[0:count] ]
+
+# Process-wide cache of the most recently used decks, evicting the least
+# recently used once the estimated total passes 'max_bytes'. Entries are
+# checked against the deck's version counter on every use, so changes
+# made by other processes are picked up on the next request. Decks too
+# big to cache at all are remembered with their version, so they aren't
+# loaded again just to find that out.
+class DeckCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.decks = OrderedDict()
+        self.oversize = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, deck):
+        key = (deck.path, deck.name)
+        version = deck.get_config_item(u"version")
+        with self.lock:
+            cached = self.decks.pop(key, None)
+            if (cached is not None and cached.version == version):
+                self.decks[key] = cached
+                self.hits += 1
+                return cached
+            self.misses += 1
+            if (self.oversize.get(key) == version):
+                return None
+
+        cached = deck.load_cached(version, self.max_bytes)
+        with self.lock:
+            self.decks.pop(key, None)
+            if (cached is None):
+                self.oversize[key] = version
+                return None
+            self.oversize.pop(key, None)
+            self.decks[key] = cached
+            total = sum(c.size for c in self.decks.values())
+            while (total > self.max_bytes):
+                total -= self.decks.popitem(last=False)[1].size
+        return cached
+
+    # Keep a cached deck current after Deck.save, rather than reloading
+    # it: if the save was the only change since the deck was cached, the
+    # card is updated in place; otherwise the entry is dropped.
+    def card_saved(self, deck, card):
+        key = (deck.path, deck.name)
+        version = deck.get_config_item(u"version")
+        with self.lock:
+            cached = self.decks.get(key)
+            if (cached is None):
+                return
+            if (version is None or cached.version is None
+                    or int(version) != int(cached.version) + 1):
+                del self.decks[key]
+                return
+            with cached.lock:
+                cached.add(card.__class__, card.card_id, card.text, card.author.id, card.author.name)
+                cached.version = version
+
+    def clear(self):
+        with self.lock:
+            self.decks.clear()
+            self.oversize.clear()
+
+deck_cache = DeckCache(deck_cache_bytes)
+
+# Encoded responses, most recently used first out of 'max_bytes'. Each
+# entry expires 'ttl' seconds after it was stored. Invalidating a team
+# bumps its generation, which is part of every key, so its old entries
+# are never hit again and just age out.
+class ResponseCache:
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.size = 0
+
+    def key(self, team_id, *parts):
+        with self.lock:
+            return (team_id, self.generations.get(team_id, 0)) + parts
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if (entry is None):
+                return None
+            (body, expires) = entry
+            if (timer() >= expires):
+                self.size -= len(body)
+                return None
+            self.entries[key] = entry
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if (old is not None):
+                self.size -= len(old[0])
+            if (len(body) > self.max_bytes):
+                return
+            self.entries[key] = (body, timer() + self.ttl)
+            self.size += len(body)
+            while (self.size > self.max_bytes):
+                self.size -= len(self.entries.popitem(last=False)[1][0])
+
+    def invalidate(self, team_id):
+        with self.lock:
+            self.generations[team_id] = self.generations.get(team_id, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+response_cache = ResponseCache(response_cache_bytes, response_cache_ttl)
+
+# Process-wide registry of open decks, keyed by team. Opening a deck
+# costs a connect and the schema checks above, so keep the most
+# recently used ones around and evict the least recently used once
+# there are more than 'size' of them. Decks are opened outside of the
+# pool lock (a first open may have a migration to run), with an event
+# per name so that other requests for the same team wait for that open
+# rather than starting their own.
+class DeckPool:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.decks = OrderedDict()
+        self.opening = {}
+
+    def __checkout(self, deck_name):
+        evicted = []
+        while True:
+            with self.lock:
+                deck = self.decks.pop(deck_name, None)
+                if (deck is not None):
+                    self.decks[deck_name] = deck
+                    break
+                opening = self.opening.get(deck_name)
+                if (opening is None):
+                    opening = self.opening[deck_name] = threading.Event()
+                    break
+            # Someone else is opening it; if their open failed, the
+            # next time round tries again.
+            opening.wait()
+
+        if (deck is None):
+            try:
+                deck = Deck(deck_name)
+            finally:
+                with self.lock:
+                    del self.opening[deck_name]
+                    if (deck is not None):
+                        self.decks[deck_name] = deck
+                opening.set()
+
+        with self.lock:
+            while (len(self.decks) > self.size):
+                evicted.append(self.decks.popitem(last=False)[1])
+
+        # Close outside of the pool lock; this waits for anyone still
+        # using an evicted deck to finish with it.
+        for old in evicted:
+            with old.lock:
+                old.close()
+        return deck
+
+    # Drop 'deck' from the pool, if it's still the one held for its name.
+    def __discard(self, deck):
+        with self.lock:
+            if (self.decks.get(deck.name) is deck):
+                del self.decks[deck.name]
+
+    @contextmanager
+    def deck(self, deck_name):
+        started = timer()
+        while True:
+            deck = self.__checkout(deck_name)
+            with deck.lock:
+                if (deck.connection is None):
+                    # Evicted and closed between checkout and lock, or left
+                    # without a connection by a failed reconnect or close;
+                    # try again with a fresh one.
+                    self.__discard(deck)
+                    continue
+                if deck.is_stale():
+                    try:
+                        deck.connect()
+                    except:
+                        # Don't leave a half-open deck for the next request.
+                        self.__discard(deck)
+                        raise
+                metrics.record_stage(u"deck", timer() - started)
+                try:
+                    yield deck
+                except:
+                    # Don't hand an open transaction to the next request.
+                    deck.connection.rollback()
+                    raise
+                return
+
+    def close(self):
+        with self.lock:
+            decks = list(self.decks.values())
+            self.decks.clear()
+        for deck in decks:
+            with deck.lock:
+                deck.close()
+
+deck_pool = DeckPool(deck_pool_size)
+
 def handle_status(deck):
     status = deck.get_status()
 
@@ -423,70 +2361,108 @@ def handle_draw(deck):
         'raw': round_as_dict(black_card, white_cards)
     }
 
+def handle_rounds(deck, count):
+    if (count < 1 or count > max_rounds):
+        raise SlackError(u"Can only deal 1 to {0} rounds at once.".format(max_rounds))
+
+    rounds = deck.draw_rounds(count)
+    return {
+        'response_type': 'in_channel',
+        'text': u"\n".join([ u"{0}. {1}".format(i + 1, round_as_text(b, w))
+                             for (i, (b, w)) in enumerate(rounds) ]),
+        'raw': [ round_as_dict(b, w) for (b, w) in rounds ]
+    }
+
 def handle_deal(deck, text):
     ids = text.split()
     if (len(ids) == 0):
         raise SlackError(u"Usage: deal <id> [<id> ...]");
 
-    first = deck.get_card_by_id(ids[0])
+    # "any" can be used as a placeholder for "any white card" e.g.
+    # for cards with multiple blanks. Everything else (including a
+    # leading "any", which is an error) is looked up in one go.
+    def is_any(i, id):
+        return (i > 0 and id.upper() == "ANY")
+    lookup = [ id for (i, id) in enumerate(ids) if not is_any(i, id) ]
+    found = iter(deck.get_cards_by_id(lookup))
+
+    # Checked in order, so the first bad id is the one reported. None
+    # marks a card still to be drawn.
+    cards = []
+    for (i, id) in enumerate(ids):
+        if is_any(i, id):
+            cards.append(None)
+            continue
+        card = next(found)
+        if (card is None):
+            raise card_id_error(id)
+        if (i > 0 and card.ID_PREFIX != "W"):
+            raise SlackError(u"Error: Only the first card may be black.");
+        cards.append(card)
+
     # If the first card is black, then we use that.
     # Otherwise, the black card is chosen at random.
-    if (first.ID_PREFIX == "B"):
-        black_card = first;
-        ids.pop(0)
+    if (cards[0].ID_PREFIX == "B"):
+        black_card = cards.pop(0)
     else:
         black_card = deck.draw_black();
 
-    # The rest of the list needs to contain only white cards.
+    # The rest of the list contains only white cards. One draw fills
+    # the "any" slots and, if there still aren't enough, some more,
+    # without repeating a card that was asked for by id.
     cards_needed = black_card.get_pick_count();
-    # Only use as many cards as we need.
-    white_cards = []
-    for id in ids:
-        # "any" can be used as a placeholder for "any white card" e.g.
-        # for cards with multiple blanks.
-        if id.upper() == "ANY":
-            card = deck.draw_whites(1)[0];
-        else:
-            card = deck.get_card_by_id(id)
-
-        if card.ID_PREFIX == "W":
-            white_cards.append(card)
-        else:
-            raise SlackError(u"Error: Only the first card may be black.");
-
-    # Not enough? Draw some more.
-    if (len(white_cards) < cards_needed):
-        white_cards += deck.draw_whites(cards_needed-len(white_cards))
+    placeholders = len([ c for c in cards if c is None ])
+    count = placeholders + max(0, cards_needed - len(cards))
+    drawn = []
+    if (count > 0):
+        drawn = deck.draw_whites(count, exclude=set(c.card_id for c in cards if c is not None))
+    white_cards = [ c if c is not None else drawn.pop(0) for c in cards ] + drawn
 
     return {
         'response_type': 'in_channel',
         'text': round_as_text(black_card, white_cards)
     }
 
-def handle_search(deck, text):
-    cards = deck.search(text)
+def handle_search(deck, text, argv0):
+    after = None
+    match = search_after_pattern.match(text)
+    if match:
+        text = match.group(1)
+        if (match.group(2).upper() == u"B"):
+            after = (BlackCard, int(match.group(3)))
+        else:
+            after = (WhiteCard, int(match.group(3)))
 
-    if (len(cards) == 0):
+    total_count = deck.search_count(text)
+
+    if (total_count == 0):
         return ephemeral_response(
             u"No results found for {0}".format(quote(text)))
 
-    total_count = len(cards)
-    result_cap = 4
+    page_size = int(deck.get_config_option(u"search_page_size"))
+    (cards, more) = deck.search_page(text, after=after, limit=page_size)
+    if (len(cards) == 0):
+        return ephemeral_response(
+            u"No more results for {0}".format(quote(text)))
+
     card_strings = [ u"({}) {}".format(c.get_id_str(), c.text) for c in cards ]
+    returned_count = len(card_strings)
 
-    if (total_count > result_cap):
-        card_strings = card_strings[0:result_cap]
-        returned_count = len(card_strings)
-        card_strings.append(u"... and more. Please be more specific.");
-    else:
-        returned_count = len(card_strings)
+    if more:
+        card_strings.append(u"... and more: `{0} search {1} after {2}`".format(
+                                argv0, text, cards[-1].get_id_str()))
 
     attachmentText = "\n".join(card_strings)
 
+    if (after is None):
+        heading = u"Search for {0}".format(quote(text))
+    else:
+        heading = u"Search for {0} after {1}{2}".format(quote(text), after[0].ID_PREFIX, after[1])
+
     return {
         'response_type': 'ephemeral',
-        'text': u"Search for {0} ({1} of {2} results)".format(
-                    quote(text),
+        'text': u"{0} ({1} of {2} results)".format(
+                    heading,
                     returned_count,
                     total_count),
         'attachments': [
@@ -518,31 +2494,174 @@ def handle_edit(deck, text):
 
     return channel_response(reply)
 
+def handle_remove(deck, author, text):
+    card = deck.get_card_by_id(text.strip())
+    deck.remove(card, author)
+
+    reply = u"Removed card: ({0}) {1} {2}".format(
+                card.get_id_str(),
+                card.EMOJI,
+                card.text)
+
+    return channel_response(reply)
+
+def handle_config(deck, text):
+    (name, _, value) = text.strip().partition(" ")
+    value = value.strip()
+
+    if (name == u""):
+        settings = [ u"{0} = {1} ({2})".format(n, deck.get_config_option(n), u", ".join(v))
+                     for (n, v) in config_options.items() ]
+        return ephemeral_response(u"Settings:\n" + u"\n".join(settings))
+
+    if (not name in config_options):
+        raise SlackError(u"Unknown setting '{0}'.".format(name))
+    if (not value in config_options[name]):
+        raise SlackError(u"'{0}' must be one of: {1}".format(name, u", ".join(config_options[name])))
+
+    deck.set_config_item(name, value)
+    return channel_response(u"Set {0} to {1}.".format(name, value))
+
 def handle_help(argv0):
     return {
         'response_type': 'ephemeral',
         'text': ("*Help for "+argv0+"*:\n" +
                  "`"+argv0+"` - Generate a new phrase\n" +
+                 "`"+argv0+" <n>` - Generate n phrases at once\n" +
                  "`"+argv0+" white <text>` - Add a new white card\n" +
                  "`"+argv0+" black <text>` - Add a new black card; use `:blank:` or at least 3 underscores for blanks.\n" +
                  "`"+argv0+" search <str>` - Find cards with 'str'\n" +
+                 "`"+argv0+" search <str> after <id>` - More results, following card 'id'\n" +
                  "`"+argv0+" edit <id> <text>` - Edit an existing card\n" +
+                 "`"+argv0+" remove <id>` - Remove a card\n" +
                  "`"+argv0+" deal <id> [<id> ...]` - Deal specific cards\n" +
                  "`"+argv0+" status` - Database info\n" +
+                 "`"+argv0+" config [<name> <value>]` - Show or change deck settings\n" +
                  "`"+argv0+" help` - This text")
     }
 
+# Yields the same document as json.dumps() of the old dump response,
+# in chunks, so the whole deck never has to be held in memory.
 def handle_dump(deck):
-    return {
-        'response_type': 'ephermeral',
-        'cards': deck.dump(),
-    }
-
-def handler(req):
-
-    params = util.FieldStorage(req, keep_blank_values=1)
-
+    chunk = ['{"response_type": "ephermeral", "cards": {']
+    for card_class in (BlackCard, WhiteCard):
+        if (card_class is not BlackCard):
+            chunk.append(', ')
+        chunk.append('"{0}": ['.format(card_class.TABLE))
+        first = True
+        for card in deck.iter_cards(card_class):
+            if not first:
+                chunk.append(', ')
+            first = False
+            chunk.append(json.dumps(card.as_dict()))
+            if (len(chunk) >= 512):
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append(']')
+    chunk.append('}}')
+    yield ''.join(chunk)
+
+# Name a request is filed under in the metrics.
+def command_name(text):
+    cmd = (text or u"").lower()
+    if (cmd == u""):
+        return u"draw"
+    if rounds_pattern.match(cmd):
+        return u"rounds"
+    if (cmd.startswith(black_emoji) or cmd.startswith(white_emoji)):
+        return u"new_card"
+    for name in (u"help", u"status", u"search", u"edit", u"remove", u"config", u"deal", u"dump"):
+        if cmd.startswith(name):
+            return name
+    return u"unknown"
+
+# Framework-neutral request handling, shared by the mod_python handler
+# and the WSGI/ASGI apps. 'params' maps the Slack form fields to
+# unicode values. Yields the JSON response body in one or more chunks;
+# it's a generator so that a dump can be streamed while the deck is
+# still held.
+def process_request(params, may_delay=True):
+    started = timer()
+    name = command_name(params.get('text'))
+    metrics.begin_request(name, params.get('team_id'))
+    try:
+        if (may_delay and should_delay(name, params) and delayed_responder.submit(params)):
+            # Empty 200 acknowledgement; the answer follows via response_url.
+            yield ''
+            return
+        for chunk in dispatch_request(params):
+            yield chunk
+    finally:
+        metrics.record_request(timer() - started)
+        metrics.end_request()
+        metrics.maybe_flush()
+
+def should_delay(name, params):
+    return (delayed_responses and name in delayed_commands and
+            params.get('response_url', u"").startswith(response_url_prefix))
+
+# Posts a JSON body to a Slack response_url.
+class HttpPoster:
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+
+    def post(self, url, body):
+        request = Request(url, data=body,
+                          headers={'Content-Type': 'application/json; charset=utf-8'})
+        response = urlopen(request, timeout=self.timeout)
+        try:
+            response.read()
+        finally:
+            response.close()
+
+# Finishes requests on a small pool of worker threads and posts the
+# results with 'poster' (anything with a post(url, body) method, so a
+# local stub can stand in for Slack). The queue is bounded: submit()
+# returns False when it's full and the caller answers inline instead.
+# Threads are started on first use, so that they are created in each
+# Apache child rather than in the parent before it forks.
+class DelayedResponder:
+    def __init__(self, workers, queue_size, poster):
+        self.workers = workers
+        self.poster = poster
+        self.jobs = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def __start(self):
+        with self.lock:
+            self.threads = [ t for t in self.threads if t.is_alive() ]
+            while (len(self.threads) < self.workers):
+                thread = threading.Thread(target=self.__run, name="cardigan-delayed")
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, params):
+        if (len(self.threads) < self.workers):
+            self.__start()
+        try:
+            self.jobs.put_nowait(params)
+        except queue.Full:
+            return False
+        return True
+
+    def __run(self):
+        while True:
+            params = self.jobs.get()
+            try:
+                body = b"".join([ to_bytes(chunk) for chunk in process_request(params, may_delay=False) ])
+                self.poster.post(params['response_url'], body)
+            except Exception:
+                logging.getLogger("cardigan").exception("delayed response failed")
+            finally:
+                self.jobs.task_done()
+
+delayed_responder = DelayedResponder(delayed_workers, delayed_queue_size, HttpPoster())
+
+def dispatch_request(params):
     resp = {}
+    cache_key = None
     try:
         if (not "text" in params):
             raise SlackError(u"Bad request: No text given.")
@@ -555,61 +2674,139 @@ def handler(req):
         if (not "command" in params):
             raise SlackError(u"Bad request: No command given.")
 
-        # Incoming data is application/x-www-form-urlencoded. We
-        # assume that it's UTF-8 encoded. There does not appear to
-        # be a header or anything we can check to confirm, so we
-        # just blindly convert.
-        text = params['text'].decode('utf-8')
-        deck = Deck(params['team_id'].decode('utf-8'))
-        author = User(id=params['user_id'].decode('utf-8'),
-                      name=params['user_name'].decode('utf-8'))
-        command = params['command'].decode('utf-8')
-
-        read_only = False;
-
-        web_client = "false";
-        if ("web_client" in params):
-            web_client = params['web_client'].decode('utf-8');
-
-        # Check that token matches.
-        # If this is the first time, set it.
-        # If the token doesn't match, we're read-only.
-        token = params['token'].decode('utf-8')
-        db_token = deck.get_config_item("token")
-        if not db_token:
-            deck.set_config_item("token", token)
-        elif (db_token != token):
-            read_only = True;
-
-        cmd = text.lower()
-
-        if (cmd.startswith(u"help")):
-            resp = handle_help(command)
-        elif (cmd.startswith(black_emoji) and not read_only):
-            resp = handle_new_card(u"black", deck, author, remove_first_word(text))
-        elif (cmd.startswith(white_emoji) and not read_only):
-            resp = handle_new_card(u"white", deck, author, remove_first_word(text))
-        elif (cmd.startswith(u"status")):
-            resp = handle_status(deck)
-        elif (cmd.startswith(u"search")):
-            resp = handle_search(deck, remove_first_word(text))
-        elif (cmd.startswith(u"edit") and not read_only):
-            resp = handle_edit(deck, remove_first_word(text))
-        elif (cmd.startswith(u"deal")):
-            resp = handle_deal(deck, remove_first_word(text))
-        elif (cmd.startswith(u"dump") and web_client == "true"):
-            resp = handle_dump(deck)
-        elif (text is None or text == u""):
-            resp = handle_draw(deck)
-        else:
-            resp = ephemeral_response(u"I don't understand that command.")
+        text = params['text']
+        team_id = params['team_id']
+        author = User(id=params['user_id'],
+                      name=params['user_name'])
+        command = params['command']
+
+        with deck_pool.deck(team_id) as deck:
+            read_only = False;
+
+            web_client = "false";
+            if ("web_client" in params):
+                web_client = params['web_client'];
+
+            # Check that token matches.
+            # If this is the first time, set it.
+            # If the token doesn't match, we're read-only.
+            token = params['token']
+            with metrics.timer(u"token"):
+                db_token = deck.get_config_item("token")
+                if not db_token:
+                    deck.set_config_item("token", token)
+                elif (db_token != token):
+                    read_only = True;
+
+            cmd = text.lower()
+            handle_started = timer()
+
+            name = command_name(text)
+            if (response_cache_enabled and name in response_cache_commands):
+                # Only search depends on what follows the command.
+                args = remove_first_word(text) if (name == u"search") else u""
+                cache_key = response_cache.key(team_id, command, name, args,
+                                               deck.get_config_item(u"version"))
+                body = response_cache.get(cache_key)
+                if (body is not None):
+                    metrics.record_stage(u"handle", timer() - handle_started)
+                    yield body
+                    return
+
+            if (cmd.startswith(u"help")):
+                resp = handle_help(command)
+            elif (cmd.startswith(black_emoji) and not read_only):
+                resp = handle_new_card(u"black", deck, author, remove_first_word(text))
+            elif (cmd.startswith(white_emoji) and not read_only):
+                resp = handle_new_card(u"white", deck, author, remove_first_word(text))
+            elif (cmd.startswith(u"status")):
+                resp = handle_status(deck)
+            elif (cmd.startswith(u"search")):
+                resp = handle_search(deck, remove_first_word(text), command)
+            elif (cmd.startswith(u"edit") and not read_only):
+                resp = handle_edit(deck, remove_first_word(text))
+            elif (cmd.startswith(u"remove") and not read_only):
+                resp = handle_remove(deck, author, remove_first_word(text))
+            elif (cmd.startswith(u"config") and not read_only):
+                resp = handle_config(deck, text.partition(u" ")[2])
+            elif (cmd.startswith(u"deal")):
+                resp = handle_deal(deck, remove_first_word(text))
+            elif (cmd.startswith(u"dump") and web_client == "true"):
+                # Written out while we still hold the deck.
+                for chunk in handle_dump(deck):
+                    yield chunk
+                metrics.record_stage(u"handle", timer() - handle_started)
+                return
+            elif (text is None or text == u""):
+                resp = handle_draw(deck)
+            elif (rounds_pattern.match(cmd)):
+                resp = handle_rounds(deck, int(cmd))
+            else:
+                resp = ephemeral_response(u"I don't understand that command.")
+            metrics.record_stage(u"handle", timer() - handle_started)
     except SlackError as e:
         resp = ephemeral_response(str(e.value))
+        cache_key = None
     except Exception as e:
         resp = ephemeral_response(
                     ("Unexpected exception! " + str(e)))
+        cache_key = None
+
+    with metrics.timer(u"encode"):
+        body = json.dumps(resp)
+    if (cache_key is not None):
+        response_cache.put(cache_key, body)
+    yield body
+
+def to_bytes(chunk):
+    if isinstance(chunk, bytes):
+        return chunk
+    return chunk.encode('utf-8')
+
+# Incoming data is application/x-www-form-urlencoded. We assume that
+# it's UTF-8 encoded. There does not appear to be a header or anything
+# we can check to confirm, so we just blindly convert. Only the first
+# value of a repeated field is kept.
+def parse_form(data):
+    if (bytes is str):
+        pairs = [ (k.decode('utf-8'), v.decode('utf-8'))
+                  for (k, v) in parse_qsl(data, keep_blank_values=True) ]
+    else:
+        pairs = parse_qsl(data.decode('latin-1'), keep_blank_values=True, encoding='utf-8')
+    params = {}
+    for (key, value) in pairs:
+        if (not key in params):
+            params[key] = value
+    return params
+
+def handler(req):
+    form = util.FieldStorage(req, keep_blank_values=1)
+    params = {}
+    for key in form.keys():
+        params[key] = form.getfirst(key).decode('utf-8')
 
     req.content_type = "application/json; charset=utf-8"
-    req.write(json.dumps(resp))
+    for chunk in process_request(params):
+        req.write(chunk)
 
     return apache.OK
+
+def metrics_response():
+    return to_bytes(json.dumps(metrics.snapshot()))
+
+# WSGI entry point, e.g. "gunicorn slack:application".
+def application(environ, start_response):
+    if (metrics_path and environ.get('PATH_INFO') == metrics_path):
+        start_response('200 OK', [('Content-Type', 'application/json; charset=utf-8')])
+        return [metrics_response()]
+
+    params = parse_form(to_bytes(environ.get('QUERY_STRING', '')))
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if (length > 0):
+        params.update(parse_form(environ['wsgi.input'].read(length)))
+
+    start_response('200 OK', [('Content-Type', 'application/json; charset=utf-8')])
+    return (to_bytes(chunk) for chunk in process_request(params))
@@ -0,0 +1,85 @@
+# -*- coding: utf_8 -*-
+#
+# Cardigan - ASGI entry point (Python 3), e.g. "uvicorn slack_asgi:app"
+#
+#    Part of the Salt Force Five project.
+#
+# Copyright (c) 2016, Brandon Streiff
+#
+# Permission to use, copy, modify, and/or distribute this software for
+# any purpose with or without fee is hereby granted, provided that the
+# above copyright notice and this permission notice appear in all
+# copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+# WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+# AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+# DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+# PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+# TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+# PERFORMANCE OF THIS SOFTWARE.
+#
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import slack
+
+# SQLite calls block, so requests are processed on this many threads
+# rather than on the event loop.
+worker_threads = 8
+
+executor = ThreadPoolExecutor(max_workers=worker_threads)
+
+def run_request(params):
+    # The whole body is produced on one worker thread: a deck's lock
+    # belongs to the thread that took it.
+    return b"".join(slack.to_bytes(chunk) for chunk in slack.process_request(params))
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if (message['type'] == 'http.disconnect'):
+            return None
+        body += message.get('body', b"")
+        if not message.get('more_body', False):
+            return body
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if (message['type'] == 'lifespan.startup'):
+            await send({'type': 'lifespan.startup.complete'})
+        elif (message['type'] == 'lifespan.shutdown'):
+            slack.deck_pool.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if (scope['type'] == 'lifespan'):
+        await lifespan(receive, send)
+        return
+    if (scope['type'] != 'http'):
+        return
+
+    body = await read_body(receive)
+    if (body is None):
+        return
+
+    if (slack.metrics_path and scope.get('path') == slack.metrics_path):
+        response = slack.metrics_response()
+    else:
+        params = slack.parse_form(scope.get('query_string', b""))
+        params.update(slack.parse_form(body))
+
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(executor, run_request, params)
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b"content-type", b"application/json; charset=utf-8")],
+    })
+    await send({'type': 'http.response.body', 'body': response})